@@ -0,0 +1,65 @@
+"""
+Micro-benchmark da geração de chaves de cache
+Compara a chave legada (json.dumps + MD5, calculada duas vezes no miss)
+com a chave canônica atual (calculada uma vez por requisição)
+
+Uso: cd gateway && python benchmarks/cache_key_bench.py
+"""
+
+import os
+import sys
+import json
+import timeit
+import hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from main import CacheService, cache_policy, canonical_url  # noqa: E402
+
+ITERATIONS = int(os.getenv("BENCH_ITERATIONS", 200000))
+
+URL = "http://product-service:3002/products"
+PARAMS = [("category", "electronics"), ("page", "2"), ("limit", "10"), ("minPrice", "100")]
+NAMESPACE = "products:1a144cc023a.1a144cc0242"
+
+def legacy_cache_key(method: str, url: str, params: dict = None, body=None) -> str:
+    """Implementação anterior de CacheService._generate_cache_key"""
+    key_data = {
+        "method": method,
+        "url": url,
+        "params": params or {},
+        "body": body
+    }
+    key_string = json.dumps(key_data, sort_keys=True)
+    return f"gateway_cache:{hashlib.md5(key_string.encode()).hexdigest()}"
+
+def main():
+    cache = CacheService(None)
+    defaults = cache_policy.match("products", "/products")[0].query_defaults
+    legacy_params = dict(PARAMS)
+    
+    def legacy_miss():
+        # Lookup e store calculavam a chave separadamente
+        legacy_cache_key("GET", URL, legacy_params)
+        legacy_cache_key("GET", URL, legacy_params)
+    
+    def current_miss():
+        cache._generate_cache_key("GET", URL, PARAMS, namespace=NAMESPACE, defaults=defaults)
+    
+    def current_cold_url():
+        canonical_url.cache_clear()
+        cache._generate_cache_key("GET", URL, PARAMS, namespace=NAMESPACE, defaults=defaults)
+    
+    results = {}
+    for name, fn in (("legada (miss)", legacy_miss), ("canônica (miss)", current_miss),
+                     ("canônica (URL fora do cache)", current_cold_url)):
+        seconds = min(timeit.repeat(fn, number=ITERATIONS, repeat=3))
+        results[name] = seconds / ITERATIONS * 1e6
+    
+    baseline = results["legada (miss)"]
+    print(f"Iterações: {ITERATIONS}")
+    for name, micros in results.items():
+        print(f"{name:32s} {micros:8.2f} µs/requisição  ({baseline / micros:.2f}x)")
+
+if __name__ == "__main__":
+    main()
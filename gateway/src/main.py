@@ -4,20 +4,48 @@ Sistema de gateway que atua como intermediário entre clientes e APIs externas
 """
 
 import os
+import re
+import gzip
 import json
+import math
+import time
+import heapq
+import random
+import asyncio
+import bisect
+import secrets
+import struct
+import fnmatch
 import hashlib
-from typing import Optional, Dict, Any
-from datetime import datetime, timedelta
+import functools
+from email.utils import parsedate_to_datetime
+from collections import Counter, OrderedDict
+from typing import Optional, Dict, Any, List, Tuple, Union
+from urllib.parse import urlsplit, urlunsplit
+from datetime import datetime, timedelta, timezone
 
 import httpx
 import redis.asyncio as redis
+from redis.asyncio.cluster import ClusterNode
+from redis.commands.core import AsyncScript
+from redis.exceptions import MaxConnectionsError, NoScriptError
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import structlog
 from dotenv import load_dotenv
 
+try:
+    import zstandard
+except ImportError:  # Dependência opcional: sem ela, o codec zstd cai para gzip
+    zstandard = None
+
+try:
+    import xxhash
+except ImportError:  # Dependência opcional: sem ela, as chaves usam blake2b de 128 bits
+    xxhash = None
+
 # Carregar variáveis de ambiente
 load_dotenv()
 
@@ -27,11 +55,142 @@ logger = structlog.get_logger()
 # Configurações
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# Nós para sharding por hash consistente ("host:porta,host:porta"); vazio usa REDIS_HOST / REDIS_PORT
+REDIS_NODES = [node.strip() for node in os.getenv("REDIS_NODES", "").split(",") if node.strip()]
+REDIS_VNODES = int(os.getenv("REDIS_VNODES", 160))
+REDIS_HEALTH_CHECK_INTERVAL = float(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 1.0))
+REDIS_NODE_ADDRESSES = [
+    (host, int(port)) for host, _, port in (node.rpartition(":") for node in REDIS_NODES)
+] or [(REDIS_HOST, REDIS_PORT)]
+# Redis Cluster: REDIS_NODES / REDIS_HOST viram os nós iniciais e o roteamento fica por slot
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
+# Leituras do cache em réplicas (escritas sempre no primário); fora do cluster, réplicas em REDIS_REPLICAS
+REDIS_READ_FROM_REPLICAS = os.getenv("REDIS_READ_FROM_REPLICAS", "false").lower() == "true"
+REDIS_REPLICA_ADDRESSES = [
+    (host, int(port)) for host, _, port in (
+        node.strip().rpartition(":") for node in os.getenv("REDIS_REPLICAS", "").split(",") if node.strip()
+    )
+]
 CACHE_TTL = int(os.getenv("CACHE_TTL", 300))
+# Janela após o TTL em que a cópia expirada ainda pode ser servida (TTL "hard" = CACHE_TTL + CACHE_STALE_TTL)
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", 60))
+CACHE_STALE_WHILE_REVALIDATE = os.getenv("CACHE_STALE_WHILE_REVALIDATE", "true").lower() == "true"
+CACHE_STALE_IF_ERROR = os.getenv("CACHE_STALE_IF_ERROR", "true").lower() == "true"
+# Cache negativo: 404 / 410 por alguns segundos e, opcionalmente, 5xx por alguns
+# milissegundos para proteger um serviço degradado (0 desativa)
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", 30))
+NEGATIVE_CACHE_STATUSES = frozenset({404, 410})
+ERROR_CACHE_TTL_MS = int(os.getenv("ERROR_CACHE_TTL_MS", 0))
+# Expiração antecipada probabilística (XFetch): hits próximos da expiração
+# disparam uma atualização em background com chance crescente, ponderada pela
+# duração da última busca upstream; o jitter encurta o TTL soft aleatoriamente
+# para que entradas criadas juntas não expirem juntas
+CACHE_EARLY_REFRESH = os.getenv("CACHE_EARLY_REFRESH", "false").lower() == "true"
+CACHE_EARLY_REFRESH_BETA = float(os.getenv("CACHE_EARLY_REFRESH_BETA", 1.0))
+CACHE_TTL_JITTER = float(os.getenv("CACHE_TTL_JITTER", 0.1))
 API_PORT = int(os.getenv("API_PORT", 8000))
 USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://localhost:3001")
 PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", "http://localhost:3002")
 
+# Cache L1 (memória do processo, na frente do Redis)
+L1_CACHE_ENABLED = os.getenv("L1_CACHE_ENABLED", "true").lower() == "true"
+L1_CACHE_MAX_ENTRIES = int(os.getenv("L1_CACHE_MAX_ENTRIES", 1000))
+L1_CACHE_MAX_BYTES = int(os.getenv("L1_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+L1_CACHE_TTL = float(os.getenv("L1_CACHE_TTL", 30))
+# Invalidação do L1: "ttl" (só expiração) ou "tracking" (CLIENT TRACKING do Redis
+# remove as cópias locais quando qualquer réplica altera ou apaga a chave)
+L1_CACHE_INVALIDATION = os.getenv("L1_CACHE_INVALIDATION", "ttl").lower()
+# Modo do tracking: "bcast" (toda chave com o prefixo) ou "optin" (só as chaves lidas pelo gateway)
+L1_TRACKING_MODE = os.getenv("L1_TRACKING_MODE", "bcast").lower()
+L1_TRACKING_PREFIX = os.getenv("L1_TRACKING_PREFIX", "gateway_cache:")
+TRACKING_INVALIDATION_CHANNEL = "__redis__:invalidate"
+# Invalidações recentes lembradas para descartar leituras que correram com elas
+TRACKING_RECENT_MAX = int(os.getenv("TRACKING_RECENT_MAX", 10000))
+
+# Detecção de chaves quentes (Count-Min + top-K) e fixação no L1
+HOT_KEYS_ENABLED = os.getenv("HOT_KEYS_ENABLED", "true").lower() == "true"
+HOT_KEYS_TOP_K = int(os.getenv("HOT_KEYS_TOP_K", 32))
+HOT_KEYS_SKETCH_WIDTH = int(os.getenv("HOT_KEYS_SKETCH_WIDTH", 2048))
+HOT_KEYS_SKETCH_DEPTH = int(os.getenv("HOT_KEYS_SKETCH_DEPTH", 4))
+# Hits mínimos na janela para uma chave do top-K ser fixada; a cada janela as contagens caem pela metade
+HOT_KEYS_MIN_HITS = int(os.getenv("HOT_KEYS_MIN_HITS", 50))
+HOT_KEYS_DECAY_INTERVAL = float(os.getenv("HOT_KEYS_DECAY_INTERVAL", 10))
+# Intervalo de recarga das chaves fixadas a partir do Redis
+HOT_KEYS_REFRESH_INTERVAL = float(os.getenv("HOT_KEYS_REFRESH_INTERVAL", 1.0))
+
+# Coalescência de misses concorrentes: "off", "local" (por processo) ou "redis" (entre réplicas)
+SINGLE_FLIGHT_MODE = os.getenv("SINGLE_FLIGHT_MODE", "local").lower()
+SINGLE_FLIGHT_LOCK_TTL = float(os.getenv("SINGLE_FLIGHT_LOCK_TTL", 10))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv("SINGLE_FLIGHT_POLL_INTERVAL", 0.05))
+
+# Invalidação incremental (SCAN + UNLINK em lotes)
+INVALIDATION_SCAN_COUNT = int(os.getenv("INVALIDATION_SCAN_COUNT", 500))
+INVALIDATION_BATCH_PAUSE = float(os.getenv("INVALIDATION_BATCH_PAUSE", 0.0))
+INVALIDATION_JOBS_HISTORY = int(os.getenv("INVALIDATION_JOBS_HISTORY", 100))
+
+# Conexões Redis: pool por nó, unix socket (nó único) e timeouts de socket como última barreira
+REDIS_SOCKET_PATH = os.getenv("REDIS_SOCKET_PATH", "")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 1.0))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 1.0))
+# Prazo de cada operação do cache; estourado, a requisição segue como miss
+REDIS_OP_TIMEOUT_MS = float(os.getenv("REDIS_OP_TIMEOUT_MS", 5))
+# Latência média (EWMA) acima do limite: o cache Redis é pulado e a requisição vai direto ao upstream,
+# com uma operação de sondagem a cada REDIS_BYPASS_PROBE_INTERVAL segundos
+REDIS_LATENCY_GUARD = os.getenv("REDIS_LATENCY_GUARD", "true").lower() == "true"
+REDIS_LATENCY_ALPHA = float(os.getenv("REDIS_LATENCY_ALPHA", 0.1))
+REDIS_SLOW_THRESHOLD_MS = float(os.getenv("REDIS_SLOW_THRESHOLD_MS", 3))
+REDIS_BYPASS_PROBE_INTERVAL = float(os.getenv("REDIS_BYPASS_PROBE_INTERVAL", 0.1))
+
+# Micro-batching: comandos de requisições concorrentes no mesmo pipeline
+# (janela 0 = agrupa o que for emitido no mesmo tick do event loop)
+REDIS_BATCHING = os.getenv("REDIS_BATCHING", "true").lower() == "true"
+REDIS_BATCH_WINDOW_MS = float(os.getenv("REDIS_BATCH_WINDOW_MS", 0))
+REDIS_BATCH_MAX_SIZE = int(os.getenv("REDIS_BATCH_MAX_SIZE", 256))
+
+# Barramento de invalidação entre réplicas (pub/sub com número de sequência)
+INVALIDATION_BUS_ENABLED = os.getenv("INVALIDATION_BUS_ENABLED", "true").lower() == "true"
+INVALIDATION_BUS_CHANNEL = os.getenv("INVALIDATION_BUS_CHANNEL", "gateway_meta:invalidations")
+INVALIDATION_SEQ_KEY = os.getenv("INVALIDATION_SEQ_KEY", "gateway_meta:invalidation_seq")
+
+# Gerações de namespace (invalidação O(1) por serviço / prefixo de rota)
+GENERATIONS_KEY = os.getenv("GENERATIONS_KEY", "gateway_meta:generations")
+GENERATIONS_LOCAL_TTL = float(os.getenv("GENERATIONS_LOCAL_TTL", 1.0))
+
+# Compressão dos corpos armazenados: "zstd", "gzip" ou "off"
+CACHE_COMPRESSION = os.getenv("CACHE_COMPRESSION", "zstd").lower()
+CACHE_COMPRESSION_MIN_SIZE = int(os.getenv("CACHE_COMPRESSION_MIN_SIZE", 1024))
+CACHE_COMPRESSION_LEVEL = int(os.getenv("CACHE_COMPRESSION_LEVEL", 3))
+
+# Headers da resposta upstream preservados no cache e devolvidos ao cliente.
+# A posição na tupla é o id do header no envelope binário: apenas acrescente no final.
+CACHED_RESPONSE_HEADERS = (
+    "content-type", "content-language", "etag", "last-modified", "vary", "cache-control", "expires"
+)
+
+# Headers repetidos em respostas 304 (RFC 9110, seção 15.4.5), mais o Age
+NOT_MODIFIED_HEADERS = ("cache-control", "etag", "expires", "vary", "age")
+
+# Headers condicionais do cliente, avaliados pelo gateway e não repassados nas buscas que alimentam o cache
+CONDITIONAL_REQUEST_HEADERS = ("if-none-match", "if-modified-since")
+
+# Headers de Vary aprendidos das respostas upstream (por chave base, LRU)
+VARY_REGISTRY_MAX_ENTRIES = int(os.getenv("VARY_REGISTRY_MAX_ENTRIES", 10000))
+# O gateway trata a codificação por conta própria (httpx descomprime o upstream)
+IGNORED_VARY_HEADERS = frozenset({"accept-encoding"})
+
+# Tags de cache: sets no Redis com as chaves de cada tag
+TAG_KEY_PREFIX = "gateway_cache:tags:"
+TAG_COMPACT_THRESHOLD = int(os.getenv("TAG_COMPACT_THRESHOLD", 1000))
+TAG_COMPACT_INTERVAL = float(os.getenv("TAG_COMPACT_INTERVAL", 60))
+
+# Política de cache por rota (TTL, cacheabilidade, regras de chave, tags e
+# invalidação), recarregada sem reiniciar os workers quando o arquivo muda
+CACHE_POLICY_FILE = os.getenv(
+    "CACHE_POLICY_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache_policy.json")
+)
+CACHE_POLICY_RELOAD_INTERVAL = float(os.getenv("CACHE_POLICY_RELOAD_INTERVAL", 5))
+
 # Inicializar FastAPI
 app = FastAPI(
     title="API Gateway",
@@ -48,57 +207,2301 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Cliente Redis
+# Cliente Redis (primeiro nó) e anel de nós usado pelo cache
 redis_client: Optional[redis.Redis] = None
+redis_ring: Optional["RedisRing"] = None
+redis_monitor: Optional[asyncio.Task] = None
 
 # Cliente HTTP
 http_client = httpx.AsyncClient(timeout=30.0)
 
-class CacheService:
-    """Serviço de cache com Redis"""
-    
-    def __init__(self, redis_client: redis.Redis):
-        self.redis = redis_client
-    
-    def _generate_cache_key(self, method: str, url: str, params: Dict = None, body: Any = None) -> str:
-        """Gera chave única para cache baseada na requisição"""
-        key_data = {
-            "method": method,
-            "url": url,
-            "params": params or {},
-            "body": body
+# Métricas de cache do processo
+cache_metrics: Counter = Counter()
+
+class LocalCache:
+    """Cache L1 em memória do processo, com eviction LRU e limite de entradas e bytes
+    
+    Chaves fixadas (pin) não são removidas pela eviction; continuam sujeitas à
+    expiração e à invalidação.
+    """
+    
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # chave -> (valor, tamanho em bytes, expiração em time.monotonic())
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pinned: set = set()
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Recupera valor do L1, respeitando a expiração"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, _, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: str, value: Any, size: int, ttl: float) -> None:
+        """Armazena valor no L1; o TTL nunca ultrapassa o TTL restante no Redis"""
+        ttl = min(self.ttl, ttl)
+        self._remove(key)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        self._entries[key] = (value, size, time.monotonic() + ttl)
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            victim = next((k for k in self._entries if k not in self.pinned), None)
+            if victim is None:
+                break
+            self._remove(victim)
+            self.evictions += 1
+    
+    def pin(self, key: str) -> None:
+        """Protege a chave da eviction LRU"""
+        self.pinned.add(key)
+    
+    def unpin(self, key: str) -> None:
+        """Devolve a chave à eviction LRU"""
+        self.pinned.discard(key)
+    
+    def delete(self, key: str) -> None:
+        """Remove uma chave do L1"""
+        self._remove(key)
+    
+    def delete_pattern(self, pattern: str) -> int:
+        """Remove chaves do L1 por padrão glob (mesma sintaxe do Redis)"""
+        keys = [key for key in self._entries if fnmatch.fnmatchcase(key, pattern)]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+    
+    def clear(self) -> None:
+        """Esvazia o L1"""
+        self._entries.clear()
+        self.pinned.clear()
+        self.size_bytes = 0
+    
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[1]
+    
+    def stats(self) -> Dict:
+        """Estatísticas do L1; cada hit é uma chamada ao Redis evitada"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "pinned": len(self.pinned),
+            "redis_calls_saved": self.hits
+        }
+
+class HotKeyTracker:
+    """Frequência das chaves em memória limitada: Count-Min sketch e heap com o top-K
+    
+    O sketch superestima (nunca subestima) a contagem de cada chave; o heap
+    mantém as K maiores estimativas. A cada HOT_KEYS_DECAY_INTERVAL todas as
+    contagens caem pela metade, para que o top-K acompanhe o tráfego recente.
+    """
+    
+    def __init__(
+        self,
+        top_k: int = HOT_KEYS_TOP_K,
+        width: int = HOT_KEYS_SKETCH_WIDTH,
+        depth: int = HOT_KEYS_SKETCH_DEPTH,
+        min_hits: int = HOT_KEYS_MIN_HITS,
+        decay_interval: float = HOT_KEYS_DECAY_INTERVAL
+    ):
+        self.top_k = top_k
+        self.width = width
+        self.depth = depth
+        self.min_hits = min_hits
+        self.decay_interval = decay_interval
+        self._rows = [[0] * width for _ in range(depth)]
+        # chave -> contagem estimada; o heap pode ter pares desatualizados (corrigidos ao chegar ao topo)
+        self.top: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []
+        self._next_decay = time.monotonic() + decay_interval
+    
+    def record(self, key: str) -> bool:
+        """Conta um acesso; retorna True se a chave está entre as quentes"""
+        if time.monotonic() >= self._next_decay:
+            self.decay()
+        count = None
+        for seed, row in enumerate(self._rows):
+            index = hash((seed, key)) % self.width
+            row[index] += 1
+            count = row[index] if count is None else min(count, row[index])
+        
+        if key in self.top:
+            self.top[key] = count
+        elif len(self.top) < self.top_k:
+            self.top[key] = count
+            heapq.heappush(self._heap, (count, key))
+        else:
+            floor_count, floor_key = self._floor()
+            if count <= floor_count:
+                return False
+            heapq.heapreplace(self._heap, (count, key))
+            del self.top[floor_key]
+            self.top[key] = count
+        return count >= self.min_hits
+    
+    def _floor(self) -> Tuple[int, str]:
+        """Menor contagem do top-K, atualizando pares desatualizados do heap"""
+        while True:
+            count, key = self._heap[0]
+            current = self.top.get(key)
+            if current == count:
+                return count, key
+            if current is None:
+                heapq.heappop(self._heap)
+            else:
+                heapq.heapreplace(self._heap, (current, key))
+    
+    def decay(self) -> None:
+        """Divide todas as contagens por dois"""
+        self._rows = [[value >> 1 for value in row] for row in self._rows]
+        self.top = {key: count >> 1 for key, count in self.top.items()}
+        self._heap = [(count, key) for key, count in self.top.items()]
+        heapq.heapify(self._heap)
+        self._next_decay = time.monotonic() + self.decay_interval
+    
+    def is_hot(self, key: str) -> bool:
+        """Indica se a chave está no top-K com o mínimo de hits"""
+        return self.top.get(key, 0) >= self.min_hits
+    
+    def hot_keys(self) -> List[Tuple[str, int]]:
+        """Top-K em ordem decrescente de contagem estimada"""
+        return sorted(self.top.items(), key=lambda item: item[1], reverse=True)
+
+async def enable_tracking(connection: redis.Connection, redirect: int, *options: str) -> None:
+    """Ativa CLIENT TRACKING na conexão, redirecionando as invalidações para `redirect`"""
+    await connection.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", redirect, *options)
+    if await connection.read_response() not in (b"OK", "OK"):
+        raise redis.ConnectionError("CLIENT TRACKING não foi ativado")
+
+class TrackingMixin:
+    """Conexão do pool de dados que ativa CLIENT TRACKING OPTIN ao conectar
+    
+    As invalidações (RESP2) das chaves lidas com CLIENT CACHING YES são
+    redirecionadas para a conexão do TrackingInvalidator, inscrita em
+    __redis__:invalidate. NOLOOP só cobre as escritas feitas pela própria
+    conexão: uma escrita do gateway por outra conexão do pool também volta
+    como invalidação (por isso set() não preenche o L1 com tracking).
+    """
+    
+    def __init__(self, *, tracking_redirect: Optional[int] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.tracking_redirect = tracking_redirect
+    
+    async def on_connect(self) -> None:
+        await super().on_connect()
+        if self.tracking_redirect is None:
+            return
+        await enable_tracking(self, self.tracking_redirect, "NOLOOP", "OPTIN")
+
+class TrackingConnection(TrackingMixin, redis.Connection):
+    """Conexão TCP com CLIENT TRACKING"""
+
+class TrackingUnixConnection(TrackingMixin, redis.UnixDomainSocketConnection):
+    """Conexão por unix socket com CLIENT TRACKING"""
+
+class TrackingInvalidator:
+    """Conexão dedicada que recebe as invalidações do CLIENT TRACKING e remove as chaves do L1
+    
+    No modo "bcast", uma única conexão ociosa rastreia o prefixo (cada escrita
+    gera uma só invalidação, em vez de uma por conexão do pool); no "optin",
+    as conexões do pool rastreiam as chaves que leem. Se alguma conexão de
+    tracking cai, mensagens podem ter sido perdidas: até reconectar o L1 não é
+    preenchido, e o L1 é esvaziado na queda e de novo após a reconexão.
+    """
+    
+    def __init__(
+        self,
+        local: LocalCache,
+        host: str = REDIS_HOST,
+        port: int = REDIS_PORT,
+        socket_path: Optional[str] = None
+    ):
+        self.local = local
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.client_id: Optional[int] = None
+        # Contador de invalidações; leituras que correram com uma invalidação da mesma chave não preenchem o L1
+        self.generation = 0
+        self._recent: "OrderedDict[str, int]" = OrderedDict()
+        self._flushed_at = 0
+        self._pruned_at = 0
+        self._connection: Optional[redis.Connection] = None
+        self._tracker: Optional[redis.Connection] = None
+        self.connected = False
+        self.invalidated_keys = 0
+        self.flushes = 0
+        self.reconnects = 0
+    
+    def _new_connection(self) -> redis.Connection:
+        if self.socket_path:
+            return redis.UnixDomainSocketConnection(path=self.socket_path, socket_connect_timeout=5)
+        return redis.Connection(host=self.host, port=self.port, socket_connect_timeout=5)
+    
+    async def connect(self) -> int:
+        """Abre a conexão de invalidação (e, no modo bcast, a rastreada) e retorna o id usado no REDIRECT"""
+        connection = self._new_connection()
+        await connection.connect()
+        await connection.send_command("CLIENT", "ID")
+        client_id = await connection.read_response()
+        await connection.send_command("SUBSCRIBE", TRACKING_INVALIDATION_CHANNEL)
+        await connection.read_response()
+        self._connection, self.client_id = connection, client_id
+        if L1_TRACKING_MODE == "bcast":
+            tracker = self._new_connection()
+            await tracker.connect()
+            await enable_tracking(tracker, client_id, "BCAST", "PREFIX", L1_TRACKING_PREFIX)
+            self._tracker = tracker
+            run_in_background(self._watch_tracker(tracker))
+        self.connected = True
+        return client_id
+    
+    async def _watch_tracker(self, tracker: redis.Connection) -> None:
+        """A conexão rastreada não recebe respostas: a leitura só termina quando ela cai"""
+        try:
+            await tracker.read_response()
+        except Exception:
+            pass
+        if tracker is self._tracker and self.connected:
+            # Sem ela o Redis para de enviar invalidações: derruba a de invalidação para reconectar as duas
+            logger.error("Conexão rastreada do L1 perdida")
+            await self._connection.disconnect()
+    
+    async def run(self, pool: Optional[redis.ConnectionPool] = None) -> None:
+        """Consome as invalidações; em caso de falha reconecta e reinicia o pool de dados (modo optin)"""
+        while True:
+            try:
+                self.handle(await self._connection.read_response())
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Conexão de invalidação do L1 perdida", error=str(e))
+            self.connected = False
+            self.flush()
+            await self._disconnect()
+            await asyncio.sleep(1)
+            try:
+                client_id = await self.connect()
+            except Exception as e:
+                logger.error("Erro ao reconectar invalidação do L1", error=str(e))
+                continue
+            if pool is not None:
+                # Conexões existentes redirecionam para o id antigo: recriá-las com o novo
+                pool.connection_kwargs["tracking_redirect"] = client_id
+                await pool.disconnect()
+            # Escritas de outras réplicas durante a reconexão não geraram invalidação
+            self.flush()
+            self.reconnects += 1
+            logger.info("Invalidação do L1 reconectada", client_id=client_id)
+    
+    async def _disconnect(self) -> None:
+        for connection in (self._connection, self._tracker):
+            if connection is not None:
+                await connection.disconnect()
+    
+    def handle(self, message: Any) -> None:
+        """Aplica uma mensagem de __redis__:invalidate (lista de chaves, ou nula para FLUSHALL)"""
+        if not isinstance(message, list) or len(message) < 3 or message[0] != b"message":
+            return
+        keys = message[2]
+        if keys is None:
+            self.flush()
+            return
+        for key in keys:
+            key = key.decode()
+            self.generation += 1
+            self._recent[key] = self.generation
+            self._recent.move_to_end(key)
+            self.local.delete(key)
+        while len(self._recent) > TRACKING_RECENT_MAX:
+            _, self._pruned_at = self._recent.popitem(last=False)
+        self.invalidated_keys += len(keys)
+    
+    def flush(self) -> None:
+        """Esvazia o L1 (flush no Redis ou mensagens possivelmente perdidas)"""
+        self.generation += 1
+        self._flushed_at = self.generation
+        self.local.clear()
+        self.flushes += 1
+    
+    def invalidated_since(self, key: str, generation: int) -> bool:
+        """Indica se a chave pode ter sido invalidada depois de `generation` (sempre, sem conexão de invalidação)"""
+        if not self.connected:
+            return True
+        if generation == self.generation:
+            return False
+        if self._flushed_at > generation or self._pruned_at > generation:
+            return True
+        return self._recent.get(key, 0) > generation
+    
+    async def close(self) -> None:
+        """Fecha as conexões de invalidação"""
+        self.connected = False
+        await self._disconnect()
+    
+    def stats(self) -> Dict:
+        """Estatísticas da invalidação do L1 por tracking"""
+        return {
+            "enabled": True,
+            "mode": L1_TRACKING_MODE,
+            "client_id": self.client_id,
+            "invalidated_keys": self.invalidated_keys,
+            "flushes": self.flushes,
+            "reconnects": self.reconnects
+        }
+
+# Invalidação do L1 por CLIENT TRACKING (criada no startup quando habilitada) e sua tarefa
+tracking_invalidator: Optional[TrackingInvalidator] = None
+tracking_listener: Optional[asyncio.Task] = None
+
+def lua_script(source: str) -> AsyncScript:
+    """Script Lua com SHA1 pré-calculado (register_script sem cliente fixo): vai por EVALSHA"""
+    return AsyncScript(None, source.encode())
+
+# Remove o lock apenas se o valor ainda for o token de quem o criou
+RELEASE_LOCK_SCRIPT = lua_script("""
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+""")
+
+# Lê as gerações dos campos pedidos; campos ausentes (nunca criados ou
+# removidos por eviction) são inicializados com o tempo atual, que é maior
+# que qualquer geração anterior, para que entradas antigas não reapareçam
+GET_GENERATIONS_SCRIPT = lua_script("""
+local result = {}
+for i, field in ipairs(ARGV) do
+    if i > 1 then
+        local value = redis.call("HGET", KEYS[1], field)
+        if not value then
+            redis.call("HSETNX", KEYS[1], field, ARGV[1])
+            value = redis.call("HGET", KEYS[1], field)
+        end
+        result[#result + 1] = value
+    end
+end
+return result
+""")
+
+# Incrementa a geração garantindo que ela nunca volte para trás
+BUMP_GENERATION_SCRIPT = lua_script("""
+local current = tonumber(redis.call("HGET", KEYS[1], ARGV[1]) or "0")
+local new = math.max(current + 1, tonumber(ARGV[2]))
+redis.call("HSET", KEYS[1], ARGV[1], new)
+return new
+""")
+
+class NamespaceGenerations:
+    """Cache local das gerações de namespace armazenadas no Redis"""
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # campo -> (geração, instante da leitura em time.monotonic())
+        self._generations: Dict[str, tuple] = {}
+    
+    @staticmethod
+    def fields(service: str, path: str) -> tuple:
+        """Campos de geração do serviço e do prefixo (primeiro segmento) da rota"""
+        return service, f"{service}:{route_prefix(path)}"
+    
+    def get_local(self, field: str) -> Optional[int]:
+        entry = self._generations.get(field)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+        return None
+    
+    def set_local(self, field: str, generation: int) -> None:
+        self._generations[field] = (generation, time.monotonic())
+    
+    def last_known(self, field: str) -> Optional[int]:
+        entry = self._generations.get(field)
+        return entry[0] if entry is not None else None
+    
+    def clear(self) -> None:
+        self._generations.clear()
+
+def route_prefix(path: str) -> str:
+    """Primeiro segmento da rota, ex.: /products/42/stock -> /products"""
+    return "/" + path.strip("/").split("/", 1)[0]
+
+# Query string como dict ou lista de pares (preserva parâmetros repetidos)
+QueryParams = Union[Dict[str, str], List[Tuple[str, str]]]
+
+def split_path(path: str) -> List[str]:
+    """Segmentos não vazios de uma rota"""
+    return [segment for segment in path.split("/") if segment]
+
+def expand_templates(templates: List[str], params: Dict[str, str]) -> List[str]:
+    """Substitui "{nome}" pelos parâmetros; templates sem valor são descartados"""
+    expanded = []
+    for template in templates:
+        try:
+            value = template.format_map(params)
+        except (KeyError, IndexError, ValueError):
+            continue
+        if value not in expanded:
+            expanded.append(value)
+    return expanded
+
+def parse_vary_spec(spec: Any) -> Tuple[str, Optional[re.Pattern]]:
+    """Normaliza um item de vary em (header, regex opcional do valor derivado)"""
+    if isinstance(spec, str):
+        return spec.lower(), None
+    pattern = spec.get("pattern")
+    return spec["header"].lower(), re.compile(pattern) if pattern else None
+
+def parse_vary_header(value: Optional[str]) -> frozenset:
+    """Nomes do header Vary do upstream, sem os que o gateway trata sozinho"""
+    if not value:
+        return frozenset()
+    names = {name.strip().lower() for name in value.split(",") if name.strip()}
+    return frozenset(names - IGNORED_VARY_HEADERS)
+
+def merge_vary(value: Optional[str], names) -> str:
+    """Header Vary com os nomes acrescentados (sem repetir os já presentes)"""
+    present = {name.strip().lower() for name in (value or "").split(",") if name.strip()}
+    missing = ["-".join(part.capitalize() for part in name.split("-")) for name in names if name.lower() not in present]
+    return ", ".join(([value] if value else []) + missing)
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """Diretivas de um header Cache-Control (nome em minúsculas -> argumento ou None)"""
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+def directive_seconds(directives: Dict[str, Optional[str]], name: str) -> Optional[int]:
+    """Argumento numérico de uma diretiva (max-age, s-maxage...); None se ausente ou inválido"""
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    """Data HTTP (Expires, Date) em epoch; None se ausente ou inválida"""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def upstream_freshness(headers: httpx.Headers, ttl: int, stale_ttl: int) -> Optional[Tuple[int, int, int]]:
+    """TTL soft, janela stale e idade inicial de uma resposta segundo o upstream
+    
+    s-maxage tem precedência sobre max-age, que tem precedência sobre
+    Expires - Date; sem nenhum deles valem os TTLs da política. A idade
+    informada em Age é descontada do TTL. Retorna None se a resposta não pode
+    ser armazenada em cache compartilhado (no-store, no-cache ou private).
+    """
+    directives = parse_cache_control(headers.get("cache-control"))
+    if "no-store" in directives or "no-cache" in directives or "private" in directives:
+        return None
+    
+    try:
+        age = max(0, int(headers.get("age", 0)))
+    except ValueError:
+        age = 0
+    lifetime = directive_seconds(directives, "s-maxage")
+    if lifetime is None:
+        lifetime = directive_seconds(directives, "max-age")
+    if lifetime is None and "expires" in headers:
+        expires = parse_http_date(headers["expires"])
+        date = parse_http_date(headers.get("date")) or time.time()
+        # Expires inválido equivale a uma data no passado (RFC 9111)
+        lifetime = max(0, int(expires - date)) if expires is not None else 0
+    if lifetime is not None:
+        ttl = max(0, lifetime - age)
+    
+    swr = directive_seconds(directives, "stale-while-revalidate")
+    sie = directive_seconds(directives, "stale-if-error")
+    if swr is not None or sie is not None:
+        stale_ttl = max(swr or 0, sie or 0)
+    if "must-revalidate" in directives or "proxy-revalidate" in directives:
+        stale_ttl = 0
+    
+    if ttl + stale_ttl <= 0:
+        return None
+    return ttl, stale_ttl, age
+
+def downstream_cache_control(ttl: int, stale_ttl: int, private: bool = False) -> str:
+    """Cache-Control emitido pelo gateway quando o upstream não envia um"""
+    value = f"{'private' if private else 'public'}, max-age={ttl}"
+    if stale_ttl and CACHE_STALE_WHILE_REVALIDATE:
+        value += f", stale-while-revalidate={stale_ttl}"
+    return value
+
+def strong_etag(body: bytes) -> str:
+    """ETag forte derivado do hash do conteúdo"""
+    return f'"{hash128(body)}"'
+
+def opaque_etag(tag: str) -> str:
+    """ETag sem o prefixo de validador fraco (W/)"""
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+def encoded_etag(tag: str, encoding: str) -> str:
+    """ETag da representação comprimida: sufixo da codificação dentro das aspas"""
+    return f'{tag[:-1]}-{encoding}"' if tag.endswith('"') else tag
+
+def identity_etag(tag: str) -> str:
+    """ETag sem W/ e sem o sufixo de codificação (variantes comprimidas casam com a identidade)"""
+    tag = opaque_etag(tag)
+    for encoding in CODEC_IDS:
+        if encoding and tag.endswith(f'-{encoding}"'):
+            return tag[:-len(encoding) - 2] + '"'
+    return tag
+
+def is_not_modified(request_headers: Optional[Dict], response_headers: Dict) -> bool:
+    """Avalia If-None-Match (comparação fraca, ignorando a codificação) ou, na ausência dele, If-Modified-Since"""
+    if not request_headers:
+        return False
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = response_headers.get("etag")
+        if not etag:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        return identity_etag(etag) in {identity_etag(tag) for tag in if_none_match.split(",")}
+    if_modified_since = parse_http_date(request_headers.get("if-modified-since"))
+    last_modified = parse_http_date(response_headers.get("last-modified"))
+    return if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+
+def revalidation_headers(entry: Dict) -> Dict[str, str]:
+    """Validadores da entrada para a requisição condicional ao upstream"""
+    validators = {}
+    etag = entry["headers"].get("etag")
+    if etag and not entry.get("generated_etag"):
+        validators["if-none-match"] = etag
+    last_modified = entry["headers"].get("last-modified")
+    if last_modified:
+        validators["if-modified-since"] = last_modified
+    return validators
+
+def not_modified(result: Dict) -> Dict:
+    """Converte um resultado 200 em 304, sem corpo e só com os headers de validação"""
+    cache_metrics["not_modified_responses"] += 1
+    cache_metrics["not_modified_bytes_saved"] += len(result["body"])
+    return {
+        **result,
+        "status_code": 304,
+        "headers": {name: result["headers"][name] for name in NOT_MODIFIED_HEADERS if name in result["headers"]},
+        "body": b""
+    }
+
+class RoutePolicy:
+    """Política de cache de um padrão de rota
+    
+    Campos: ttl / stale_ttl (TTL soft e janela stale, usados quando o upstream
+    não envia Cache-Control / Expires), honor_cache_control (respeitar esses
+    headers), negative_ttl (segundos para 404 / 410), error_ttl_ms
+    (micro-cache de 5xx), bypass (não cachear), compression, tags (templates "{nome}" com
+    parâmetros da rota ou da query) e key (regras da chave: vary,
+    query_defaults e ignore_params).
+    """
+    
+    def __init__(
+        self,
+        service: str = "*",
+        path: str = "/*",
+        ttl: int = CACHE_TTL,
+        stale_ttl: int = CACHE_STALE_TTL,
+        honor_cache_control: bool = True,
+        negative_ttl: float = NEGATIVE_CACHE_TTL,
+        error_ttl_ms: int = ERROR_CACHE_TTL_MS,
+        bypass: bool = False,
+        compression: bool = True,
+        tags: List[str] = None,
+        key: Dict = None
+    ):
+        key = key or {}
+        self.service = service
+        self.path = path
+        self.ttl = int(ttl)
+        self.stale_ttl = int(stale_ttl)
+        self.honor_cache_control = honor_cache_control
+        self.negative_ttl = float(negative_ttl)
+        self.error_ttl_ms = int(error_ttl_ms)
+        self.bypass = bypass
+        self.compression = compression
+        self.tags = tags or []
+        self.vary = [parse_vary_spec(spec) for spec in key.get("vary", [])]
+        self.query_defaults = {name: str(value) for name, value in key.get("query_defaults", {}).items()}
+        self.ignore_params = frozenset(key.get("ignore_params", []))
+    
+    def tags_for(self, route_params: Dict[str, str], params: QueryParams = None) -> List[str]:
+        """Tags da resposta, com parâmetros da rota e da query string"""
+        if not self.tags:
+            return []
+        return expand_templates(self.tags, {**dict(params or ()), **route_params})
+    
+    def to_dict(self) -> Dict:
+        return {
+            "service": self.service,
+            "path": self.path,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "honor_cache_control": self.honor_cache_control,
+            "negative_ttl": self.negative_ttl,
+            "error_ttl_ms": self.error_ttl_ms,
+            "bypass": self.bypass,
+            "compression": self.compression,
+            "tags": self.tags,
+            "key": {
+                "vary": [name if pattern is None else {"header": name, "pattern": pattern.pattern}
+                         for name, pattern in self.vary],
+                "query_defaults": self.query_defaults,
+                "ignore_params": sorted(self.ignore_params)
+            }
+        }
+
+class InvalidationRule:
+    """Regra declarativa: mutação bem-sucedida na rota invalida os alvos listados
+    
+    Alvos: "tag:nome" (entradas com a tag), "service" (namespace do serviço),
+    "prefix:/rota" (namespace do prefixo) e "path:/rota" (entrada exata do GET
+    sem query string). Parâmetros da rota (":id") são usados como "{id}".
+    """
+    
+    def __init__(self, service: str, path: str, invalidate: List[str], methods: List[str] = None):
+        self.service = service
+        self.path = path
+        self.targets = invalidate
+        self.methods = {m.upper() for m in (methods or ["POST", "PUT", "PATCH", "DELETE"])}
+    
+    def to_dict(self) -> Dict:
+        return {
+            "service": self.service,
+            "path": self.path,
+            "methods": sorted(self.methods),
+            "invalidate": self.targets
+        }
+
+class RouteTrie:
+    """Árvore de segmentos de rota: estáticos, parâmetros (":nome") e curinga final ("*")
+    
+    O match percorre um nó por segmento, preferindo segmentos estáticos a
+    parâmetros (/products/search/:query vence /products/:id/...).
+    """
+    
+    __slots__ = ("static", "param", "param_child", "wildcard", "values")
+    
+    def __init__(self):
+        self.static: Dict[str, "RouteTrie"] = {}
+        self.param: Optional[str] = None
+        self.param_child: Optional["RouteTrie"] = None
+        self.wildcard: List[Any] = []
+        self.values: List[Any] = []
+    
+    def insert(self, path: str, value: Any) -> None:
+        node = self
+        for segment in split_path(path):
+            if segment == "*":
+                node.wildcard.append(value)
+                return
+            if segment.startswith(":"):
+                if node.param_child is None:
+                    node.param, node.param_child = segment[1:], RouteTrie()
+                elif node.param != segment[1:]:
+                    raise ValueError(f"Parâmetros conflitantes em {path}: :{node.param} e {segment}")
+                node = node.param_child
+            else:
+                node = node.static.setdefault(segment, RouteTrie())
+        node.values.append(value)
+    
+    def match(self, path: str) -> Optional[Tuple[List[Any], Dict[str, str]]]:
+        """Valores registrados para a rota e parâmetros capturados"""
+        params: Dict[str, str] = {}
+        values = self._match(split_path(path), 0, params)
+        return (values, params) if values else None
+    
+    def _match(self, segments: List[str], index: int, params: Dict[str, str]) -> Optional[List[Any]]:
+        if index == len(segments):
+            return self.values or self.wildcard or None
+        segment = segments[index]
+        child = self.static.get(segment)
+        if child is not None:
+            values = child._match(segments, index + 1, params)
+            if values:
+                return values
+        if self.param_child is not None:
+            params[self.param] = segment
+            values = self.param_child._match(segments, index + 1, params)
+            if values:
+                return values
+            del params[self.param]
+        if self.wildcard:
+            params["*"] = "/".join(segments[index:])
+            return self.wildcard
+        return None
+
+class CachePolicy:
+    """Políticas de cache compiladas em árvores de rotas por serviço"""
+    
+    def __init__(self, config: Dict, source: Optional[str] = None, mtime: Optional[float] = None):
+        self.source = source
+        self.mtime = mtime
+        self.loaded_at = datetime.utcnow()
+        defaults = config.get("defaults", {})
+        self.default_policy = RoutePolicy(**defaults)
+        self.routes: List[RoutePolicy] = []
+        self.invalidation: List[InvalidationRule] = []
+        self._routes: Dict[str, RouteTrie] = {}
+        self._invalidation: Dict[str, RouteTrie] = {}
+        
+        for route in config.get("routes", []):
+            policy = RoutePolicy(**{**defaults, **route})
+            self.routes.append(policy)
+            self._routes.setdefault(policy.service, RouteTrie()).insert(policy.path, policy)
+        for rule_config in config.get("invalidation", []):
+            rule = InvalidationRule(**rule_config)
+            self.invalidation.append(rule)
+            self._invalidation.setdefault(rule.service, RouteTrie()).insert(rule.path, rule)
+    
+    def match(self, service: str, path: str) -> Tuple[RoutePolicy, Dict[str, str]]:
+        """Política da rota (ou a padrão) e parâmetros capturados"""
+        trie = self._routes.get(service)
+        found = trie.match(path) if trie is not None else None
+        if found is None:
+            return self.default_policy, {}
+        policies, params = found
+        return policies[0], params
+    
+    def invalidation_targets(self, service: str, method: str, path: str) -> List[str]:
+        """Alvos de invalidação de uma mutação, com os parâmetros da rota aplicados"""
+        trie = self._invalidation.get(service)
+        found = trie.match(path) if trie is not None else None
+        if found is None:
+            return []
+        rules, params = found
+        targets = []
+        for rule in rules:
+            if method.upper() in rule.methods:
+                targets.extend(target for target in expand_templates(rule.targets, params) if target not in targets)
+        return targets
+    
+    def to_dict(self) -> Dict:
+        return {
+            "source": self.source,
+            "loaded_at": self.loaded_at.isoformat(),
+            "defaults": self.default_policy.to_dict(),
+            "routes": [policy.to_dict() for policy in self.routes],
+            "invalidation": [rule.to_dict() for rule in self.invalidation]
+        }
+
+def load_cache_policy(path: Optional[str] = CACHE_POLICY_FILE) -> CachePolicy:
+    """Carrega e compila o arquivo de política; sem arquivo, vale a política padrão"""
+    if not path or not os.path.exists(path):
+        logger.warning("Arquivo de política de cache não encontrado, usando padrões", path=path)
+        return CachePolicy({})
+    mtime = os.path.getmtime(path)
+    with open(path) as policy_file:
+        return CachePolicy(json.load(policy_file), source=path, mtime=mtime)
+
+# Política em uso (substituída por inteiro no reload) e tarefa que observa o arquivo
+cache_policy = load_cache_policy()
+policy_watcher: Optional[asyncio.Task] = None
+
+def reload_cache_policy(force: bool = False) -> bool:
+    """Recarrega a política se o arquivo mudou (sempre, com `force`); em caso de erro mantém a atual
+    
+    Com `force` o erro de carga é propagado, para quem pediu o reload poder reportá-lo.
+    """
+    global cache_policy
+    try:
+        mtime = os.path.getmtime(CACHE_POLICY_FILE)
+    except OSError:
+        if not force:
+            return False
+        mtime = None
+    if not force and mtime == cache_policy.mtime:
+        return False
+    try:
+        policy = load_cache_policy(CACHE_POLICY_FILE)
+    except Exception as e:
+        logger.error("Erro ao recarregar política de cache, mantendo a atual", path=CACHE_POLICY_FILE, error=str(e))
+        # Não tentar de novo até o arquivo mudar outra vez
+        cache_policy.mtime = mtime
+        if force:
+            raise
+        return False
+    cache_policy = policy
+    logger.info("Política de cache recarregada", path=CACHE_POLICY_FILE, routes=len(policy.routes))
+    return True
+
+async def watch_cache_policy() -> None:
+    """Verifica periodicamente se o arquivo de política mudou"""
+    while True:
+        await asyncio.sleep(CACHE_POLICY_RELOAD_INTERVAL)
+        reload_cache_policy()
+
+def vary_values(specs: List[Tuple[str, Optional[re.Pattern]]], headers: Dict) -> List[Tuple[str, str]]:
+    """Valores (ou valores derivados) dos headers de variação na requisição"""
+    values = []
+    for name, pattern in specs:
+        value = headers.get(name, "").strip()
+        if pattern is not None and value:
+            match = pattern.search(value)
+            value = (match.group(1) if match.groups() else match.group(0)) if match else ""
+        values.append((name, value))
+    return values
+
+class VaryRegistry:
+    """Headers de Vary aprendidos das respostas upstream, por chave base"""
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, frozenset]" = OrderedDict()
+    
+    def get(self, base_key: str) -> frozenset:
+        names = self._entries.get(base_key)
+        if names is None:
+            return frozenset()
+        self._entries.move_to_end(base_key)
+        return names
+    
+    def learn(self, base_key: str, names: frozenset) -> None:
+        self._entries[base_key] = self._entries.get(base_key, frozenset()) | names
+        self._entries.move_to_end(base_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Variações aprendidas pelo processo
+vary_registry = VaryRegistry(VARY_REGISTRY_MAX_ENTRIES)
+
+def hash128(data: bytes) -> str:
+    """Hash não criptográfico de 128 bits (xxh3) em hexadecimal"""
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def tag_key(tag: str, key: str) -> str:
+    """Chave do índice da tag para uma entrada (no Redis Cluster, no mesmo slot da entrada)"""
+    if REDIS_CLUSTER:
+        return f"{TAG_KEY_PREFIX}{tag}:{key[key.rfind('{'):]}"
+    return f"{TAG_KEY_PREFIX}{tag}"
+
+def variants_tag(base_key: str) -> str:
+    """Tag implícita das variantes (vary) de uma chave base, pelo digest (sem namespace nem hash tag)"""
+    return "variants:" + base_key.rsplit(":", 2 if REDIS_CLUSTER else 1)[1]
+
+def tag_keys(tag: str) -> List[str]:
+    """Todas as chaves de índice da tag (uma por bucket de hash tag no Redis Cluster)"""
+    if REDIS_CLUSTER:
+        return [f"{TAG_KEY_PREFIX}{tag}:{{{bucket:02x}}}" for bucket in range(256)]
+    return [f"{TAG_KEY_PREFIX}{tag}"]
+
+def hash64(data: bytes) -> int:
+    """Hash não criptográfico de 64 bits (posições no anel de nós Redis)"""
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+@functools.lru_cache(maxsize=4096)
+def canonical_url(url: str) -> str:
+    """Normaliza a URL: esquema e host em minúsculas e sem porta padrão
+    
+    O caminho fica exatamente como recebido: o upstream recebe o caminho bruto
+    e pode tratar "//" ou a barra final como outro recurso (uma 404 de
+    "/products/" não pode ficar sob a chave de "/products").
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or "/", "", ""))
+
+def canonical_query(
+    params: Optional[QueryParams],
+    defaults: Optional[Dict[str, str]] = None,
+    ignored: frozenset = frozenset()
+) -> str:
+    """Query string canônica: ordenada por nome, repetições na ordem original, sem valores padrão nem ignorados"""
+    if not params:
+        return ""
+    items = params.items() if isinstance(params, dict) else params
+    if defaults or ignored:
+        items = [
+            (name, value) for name, value in items
+            if name not in ignored and (not defaults or defaults.get(name) != value)
+        ]
+        if not items:
+            return ""
+    # sorted é estável: valores repetidos do mesmo parâmetro mantêm a ordem.
+    # repr da lista de pares é inequívoco e bem mais barato que urlencode.
+    return repr(sorted(items, key=lambda item: item[0]))
+
+# Gerações conhecidas pelo processo
+namespace_generations = NamespaceGenerations(GENERATIONS_LOCAL_TTL)
+
+# Grava a entrada e registra a chave nos sets das tags. Cada set expira junto
+# com a entrada mais duradoura que contém; retorna os sets acima do limite
+# de compactação.
+SET_WITH_TAGS_SCRIPT = lua_script("""
+local tag_ttl = tonumber(ARGV[2])
+local oversized = {}
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+for i = 2, #KEYS do
+    redis.call("SADD", KEYS[i], KEYS[1])
+    if redis.call("PTTL", KEYS[i]) < tag_ttl then
+        redis.call("PEXPIRE", KEYS[i], tag_ttl)
+    end
+    if redis.call("SCARD", KEYS[i]) > tonumber(ARGV[3]) then
+        oversized[#oversized + 1] = KEYS[i]
+    end
+end
+return oversized
+""")
+
+# Renova uma entrada confirmada pelo upstream: reescreve criação / expiração
+# soft no envelope e o TTL da chave e das tags, sem tocar no corpo.
+# Retorna 0 se a chave sumiu ou não está no envelope binário.
+REFRESH_ENTRY_SCRIPT = lua_script("""
+if redis.call("GETRANGE", KEYS[1], 0, 1) ~= ARGV[1] then
+    return 0
+end
+local ttl = tonumber(ARGV[4])
+redis.call("SETRANGE", KEYS[1], ARGV[2], ARGV[3])
+redis.call("PEXPIRE", KEYS[1], ttl)
+for i = 2, #KEYS do
+    redis.call("SADD", KEYS[i], KEYS[1])
+    if redis.call("PTTL", KEYS[i]) < ttl then
+        redis.call("PEXPIRE", KEYS[i], ttl)
+    end
+end
+return 1
+""")
+
+# Numera e publica um evento de invalidação atomicamente: a ordem das
+# mensagens no canal é a ordem da sequência, e um salto indica perda
+PUBLISH_INVALIDATION_SCRIPT = lua_script("""
+local seq = redis.call("INCR", KEYS[1])
+redis.call("PUBLISH", ARGV[1], '{"seq":' .. seq .. ',' .. string.sub(ARGV[2], 2))
+return seq
+""")
+
+# Compacta um lote do set da tag (KEYS[1]): remove os membros (KEYS[2..])
+# que não existem mais. EXISTS e SREM no mesmo script: uma entrada regravada
+# por SET_WITH_TAGS_SCRIPT entre os dois não perde o índice.
+COMPACT_TAG_SCRIPT = lua_script("""
+local removed = 0
+for i = 2, #KEYS do
+    if redis.call("EXISTS", KEYS[i]) == 0 then
+        removed = removed + redis.call("SREM", KEYS[1], KEYS[i])
+    end
+end
+return removed
+""")
+
+# Última compactação de cada set de tag neste processo
+tag_compactions: Dict[str, float] = {}
+
+# Envelope binário das entradas de cache. Cabeçalho fixo: magic, versão,
+# flags, status, criação e expiração soft (epoch em ms), quantidade de headers
+# e duração da busca upstream (µs, desde a versão 2); em seguida a tabela de
+# headers (id + tamanho + valor) e o corpo bruto.
+ENVELOPE_MAGIC = b"GW"
+ENVELOPE_VERSION = 2
+ENVELOPE_HEADER = struct.Struct(">2sBBHQQBI")
+ENVELOPE_HEADER_V1 = struct.Struct(">2sBBHQQB")
+ENVELOPE_HEADER_VALUE = struct.Struct(">BH")
+# Criação e expiração soft, reescritas no lugar quando o upstream confirma a entrada (304)
+ENVELOPE_TIMESTAMPS = struct.Struct(">QQ")
+ENVELOPE_TIMESTAMPS_OFFSET = 6
+
+# Codec do corpo, gravado nos bits baixos das flags do envelope
+ENVELOPE_CODEC_MASK = 0x03
+CODEC_IDS = {None: 0, "gzip": 1, "zstd": 2}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+# ETag gerado pelo gateway (hash do corpo): não serve para revalidar no upstream
+ENVELOPE_FLAG_GENERATED_ETAG = 0x04
+
+def resolve_codec() -> Optional[str]:
+    """Codec configurado, considerando as dependências disponíveis"""
+    if CACHE_COMPRESSION in ("off", "none", ""):
+        return None
+    if CACHE_COMPRESSION == "zstd" and zstandard is None:
+        logger.warning("Pacote zstandard não instalado, usando gzip para compressão do cache")
+        return "gzip"
+    if CACHE_COMPRESSION not in CODEC_IDS:
+        raise ValueError(f"CACHE_COMPRESSION inválido: {CACHE_COMPRESSION}")
+    return CACHE_COMPRESSION
+
+# Codec usado nas novas entradas
+cache_codec = resolve_codec()
+
+def compress_body(body: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=CACHE_COMPRESSION_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=CACHE_COMPRESSION_LEVEL)
+
+def decompress_body(body: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(body)
+    return gzip.decompress(body)
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """Indica se o Accept-Encoding do cliente aceita a codificação (q > 0)"""
+    if not accept_encoding:
+        return False
+    for item in accept_encoding.split(","):
+        token, _, params = item.partition(";")
+        if token.strip().lower() != encoding:
+            continue
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+def encode_entry(entry: Dict) -> bytes:
+    """Serializa a entrada no envelope binário"""
+    table = []
+    for header_id, name in enumerate(CACHED_RESPONSE_HEADERS):
+        value = entry["headers"].get(name)
+        if value is not None:
+            encoded = value.encode("latin-1")
+            table.append(ENVELOPE_HEADER_VALUE.pack(header_id, len(encoded)))
+            table.append(encoded)
+    header = ENVELOPE_HEADER.pack(
+        ENVELOPE_MAGIC,
+        ENVELOPE_VERSION,
+        CODEC_IDS[entry.get("encoding")] | (ENVELOPE_FLAG_GENERATED_ETAG if entry.get("generated_etag") else 0),
+        entry["status_code"],
+        int(entry["timestamp"] * 1000),
+        int(entry["expires_at"] * 1000),
+        len(table) // 2,
+        min(int(entry.get("fetch_time", 0) * 1e6), 0xFFFFFFFF)
+    )
+    return b"".join([header, *table, entry["body"]])
+
+def decode_entry(payload: bytes) -> Dict:
+    """Desserializa a entrada; o corpo é devolvido como bytes, sem nenhum parsing"""
+    if payload[:2] != ENVELOPE_MAGIC:
+        return decode_legacy_entry(payload)
+    version = payload[2]
+    if version == ENVELOPE_VERSION:
+        _, _, flags, status_code, created_ms, expires_ms, header_count, fetch_us = ENVELOPE_HEADER.unpack_from(payload)
+        offset = ENVELOPE_HEADER.size
+    elif version == 1:
+        _, _, flags, status_code, created_ms, expires_ms, header_count = ENVELOPE_HEADER_V1.unpack_from(payload)
+        fetch_us = 0
+        offset = ENVELOPE_HEADER_V1.size
+    else:
+        raise ValueError(f"Versão de envelope desconhecida: {version}")
+    
+    headers = {}
+    for _ in range(header_count):
+        header_id, length = ENVELOPE_HEADER_VALUE.unpack_from(payload, offset)
+        offset += ENVELOPE_HEADER_VALUE.size
+        if header_id < len(CACHED_RESPONSE_HEADERS):
+            headers[CACHED_RESPONSE_HEADERS[header_id]] = payload[offset:offset + length].decode("latin-1")
+        offset += length
+    return {
+        "status_code": status_code,
+        "headers": headers,
+        "timestamp": created_ms / 1000,
+        "expires_at": expires_ms / 1000,
+        "encoding": CODEC_NAMES[flags & ENVELOPE_CODEC_MASK],
+        "generated_etag": bool(flags & ENVELOPE_FLAG_GENERATED_ETAG),
+        "fetch_time": fetch_us / 1e6,
+        "body": payload[offset:]
+    }
+
+def decode_legacy_entry(payload: bytes) -> Dict:
+    """Lê entradas gravadas em JSON antes do envelope binário (compatibilidade durante o rollout)"""
+    meta, separator, body = payload.partition(b"\n")
+    entry = json.loads(meta)
+    if not separator:
+        # Documento JSON único com o corpo já decodificado
+        response_data = entry["data"]
+        entry = {
+            "status_code": response_data["status_code"],
+            "headers": {"content-type": "application/json"},
+            "timestamp": entry["timestamp"],
+            "expires_at": entry.get("expires_at", time.time())
+        }
+        body = json.dumps(response_data["data"]).encode()
+    # Timestamps legados em ISO 8601 (UTC)
+    entry["timestamp"] = datetime.fromisoformat(entry["timestamp"]).replace(tzinfo=timezone.utc).timestamp()
+    entry["body"] = body
+    return entry
+
+# Cache L1 compartilhado por todas as requisições do processo
+local_cache: Optional[LocalCache] = (
+    LocalCache(L1_CACHE_MAX_ENTRIES, L1_CACHE_MAX_BYTES, L1_CACHE_TTL) if L1_CACHE_ENABLED else None
+)
+
+
+class InvalidationBus:
+    """Propaga invalidações entre réplicas pelo pub/sub do Redis
+    
+    Cada evento (chaves, padrão ou geração de namespace) recebe um número de
+    sequência global. O assinante de cada réplica aplica os eventos das
+    outras ao estado local (L1 e gerações); se detecta um salto na sequência,
+    uma sequência reiniciada ou precisa reconectar, esvazia o estado local inteiro.
+    """
+    
+    def __init__(self, local: Optional[LocalCache], generations: NamespaceGenerations):
+        self.local = local
+        self.generations = generations
+        self.origin = secrets.token_hex(8)
+        self.last_seq = 0
+        self.published = 0
+        self.received = 0
+        self.gaps = 0
+        self.resets = 0
+        self.flushes = 0
+    
+    async def publish(self, client: redis.Redis, event: Dict) -> None:
+        """Publica um evento; falhas não interrompem a invalidação local"""
+        try:
+            payload = json.dumps({"origin": self.origin, **event})
+            await PUBLISH_INVALIDATION_SCRIPT(
+                keys=[INVALIDATION_SEQ_KEY], args=[INVALIDATION_BUS_CHANNEL, payload], client=client
+            )
+            self.published += 1
+        except Exception as e:
+            logger.error("Erro ao publicar invalidação", event_type=event.get("type"), error=str(e))
+    
+    async def run(self, ring: "RedisRing") -> None:
+        """Assina o canal e aplica os eventos; reconecta e resincroniza em caso de falha"""
+        client = ring.subscriber_for(INVALIDATION_SEQ_KEY)
+        pubsub = client.pubsub()
+        resync = True
+        topology = ring.topology
+        while True:
+            try:
+                if topology != ring.topology:
+                    # Nó saiu ou voltou ao anel: os publicadores podem ter mudado de nó
+                    topology = ring.topology
+                    resync = True
+                if resync:
+                    # Canal e sequência ficam no nó da chave de sequência (ou no que o substitui)
+                    if client is not ring.subscriber_for(INVALIDATION_SEQ_KEY):
+                        await pubsub.reset()
+                        client = ring.subscriber_for(INVALIDATION_SEQ_KEY)
+                        pubsub = client.pubsub()
+                    await pubsub.subscribe(INVALIDATION_BUS_CHANNEL)
+                    # Eventos até esta sequência já estão refletidos no Redis: basta esvaziar o estado local
+                    self.last_seq = int(await client.get(INVALIDATION_SEQ_KEY) or 0)
+                    self.flush()
+                    resync = False
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    self.handle(message["data"])
+            except asyncio.CancelledError:
+                await pubsub.reset()
+                raise
+            except Exception as e:
+                logger.error("Assinatura do barramento de invalidação perdida", error=str(e))
+                ring.report_failure(client, e)
+                resync = True
+                await pubsub.reset()
+                await asyncio.sleep(1)
+    
+    def handle(self, data: bytes) -> None:
+        """Aplica um evento recebido, conferindo a sequência"""
+        event = json.loads(data)
+        seq = event["seq"]
+        if seq == self.last_seq:
+            return
+        if seq < self.last_seq:
+            # Contador recomeçou (chave de sequência removida ou despejada): não dá para
+            # saber o que se perdeu, então esvazia o estado local e segue a nova sequência
+            self.received += 1
+            self.resets += 1
+            self.last_seq = seq
+            logger.warning("Sequência de invalidação reiniciada, esvaziando cache local", seq=seq)
+            self.flush()
+            return
+        self.received += 1
+        gap = seq != self.last_seq + 1
+        self.last_seq = seq
+        if gap:
+            self.gaps += 1
+            logger.warning("Eventos de invalidação perdidos, esvaziando cache local", seq=seq)
+            self.flush()
+        elif event.get("origin") != self.origin:
+            self.apply(event)
+    
+    def apply(self, event: Dict) -> None:
+        """Aplica um evento de outra réplica ao estado local"""
+        kind = event.get("type")
+        if kind == "keys":
+            if self.local is not None:
+                for key in event["keys"]:
+                    self.local.delete(key)
+        elif kind == "pattern":
+            if self.local is not None:
+                self.local.delete_pattern(event["pattern"])
+        elif kind == "namespace":
+            self.generations.set_local(event["field"], event["generation"])
+        else:
+            self.flush()
+    
+    def flush(self) -> None:
+        """Esvazia o L1 e as gerações conhecidas"""
+        if self.local is not None:
+            self.local.clear()
+        self.generations.clear()
+        self.flushes += 1
+    
+    def stats(self) -> Dict:
+        """Estatísticas do barramento neste processo"""
+        return {
+            "enabled": True,
+            "origin": self.origin,
+            "last_seq": self.last_seq,
+            "published": self.published,
+            "received": self.received,
+            "gaps": self.gaps,
+            "resets": self.resets,
+            "flushes": self.flushes
+        }
+
+# Barramento de invalidação do processo e tarefa do assinante (iniciada no startup)
+invalidation_bus: Optional[InvalidationBus] = (
+    InvalidationBus(local_cache, namespace_generations) if INVALIDATION_BUS_ENABLED else None
+)
+invalidation_subscriber: Optional[asyncio.Task] = None
+
+class SingleFlight:
+    """Coalescência de requisições concorrentes para a mesma chave (single-flight)"""
+    
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+    
+    async def do(self, key: str, fn) -> tuple:
+        """Executa fn uma única vez por chave; retorna (resultado, compartilhado)"""
+        task = self._inflight.get(key)
+        shared = task is not None
+        if not shared:
+            # A busca roda em task própria: se o cliente líder desconectar,
+            # os demais aguardando continuam recebendo o resultado
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._release(key, done))
+        return await asyncio.shield(task), shared
+    
+    def _release(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+    
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+# Buscas em andamento no processo
+single_flight = SingleFlight()
+
+# Frequência das chaves lidas do cache neste processo
+hot_keys: Optional[HotKeyTracker] = HotKeyTracker() if HOT_KEYS_ENABLED else None
+hot_key_refresher: Optional[asyncio.Task] = None
+
+async def refresh_hot_keys() -> None:
+    """Recarrega periodicamente as chaves quentes fixadas no L1"""
+    while True:
+        await asyncio.sleep(HOT_KEYS_REFRESH_INTERVAL)
+        try:
+            await CacheService(redis_ring or redis_client, local_cache).reload_pinned()
+        except Exception as e:
+            logger.error("Erro ao recarregar chaves quentes", error=str(e))
+
+# Referências para tasks em background (evita coleta pelo GC antes de terminarem)
+background_tasks: set = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    """Agenda corrotina em background mantendo referência até o fim"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def redis_connection_options() -> Dict[str, Any]:
+    """Opções de conexão e de pool comuns a todos os clientes Redis do cache"""
+    return {
+        # Modo bytes: o envelope binário das entradas é lido sem decodificação
+        "decode_responses": False,
+        "socket_connect_timeout": REDIS_CONNECT_TIMEOUT,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        # Pool esgotado falha na hora (a requisição segue como miss) em vez de enfileirar;
+        # não conta como falha do nó (ver RedisRing.report_failure)
+        "max_connections": REDIS_MAX_CONNECTIONS
+    }
+
+def create_redis_client(host: str, port: int, socket_path: Optional[str] = None) -> redis.Redis:
+    """Cliente para um nó Redis com as opções do cache (por unix socket quando `socket_path`)"""
+    if socket_path:
+        return redis.Redis(unix_socket_path=socket_path, **redis_connection_options())
+    return redis.Redis(host=host, port=port, **redis_connection_options())
+
+async def scan_batches(client: redis.Redis, pattern: str):
+    """Lotes de chaves que casam com o padrão, via SCAN (no Redis Cluster, em todos os primários)"""
+    if isinstance(client, redis.RedisCluster):
+        batch = []
+        async for key in client.scan_iter(match=pattern, count=INVALIDATION_SCAN_COUNT):
+            batch.append(key)
+            if len(batch) >= INVALIDATION_SCAN_COUNT:
+                yield batch
+                batch = []
+        yield batch
+        return
+    cursor = 0
+    while True:
+        cursor, keys = await client.scan(cursor=cursor, match=pattern, count=INVALIDATION_SCAN_COUNT)
+        yield keys
+        if cursor == 0:
+            return
+
+def primary_command(client: redis.Redis, name: str, key: str) -> Tuple[str, tuple, dict]:
+    """Leitura de uma chave fixada no primário (no RedisCluster com leitura em réplicas, via target_nodes)"""
+    if isinstance(client, redis.RedisCluster) and client.read_from_replicas:
+        return "execute_command", (name.upper(), key), {"target_nodes": client.get_node_from_key(key)}
+    return name, (key,), {}
+
+class RedisRing:
+    """Anel de hash consistente sobre os nós Redis do cache
+    
+    Cada nó ocupa REDIS_VNODES pontos do anel (nós virtuais), então incluir ou
+    remover um nó remapeia só ~1/N das chaves. A chave vai para o primeiro nó
+    saudável no sentido horário; um nó indisponível é pulado até voltar e,
+    ao voltar, tem as entradas do cache e as gerações de namespace
+    descartadas (pode ter perdido invalidações enquanto esteve fora; as
+    gerações recriadas são maiores que todas as anteriores). Com um único nó (inclusive um
+    RedisCluster, que roteia por slot sozinho), leituras podem ir para réplicas.
+    """
+    
+    def __init__(
+        self,
+        nodes: List[redis.Redis],
+        names: Optional[List[str]] = None,
+        vnodes: int = REDIS_VNODES,
+        replicas: Optional[List[redis.Redis]] = None,
+        replica_names: Optional[List[str]] = None
+    ):
+        self.nodes = nodes
+        self.names = names or [f"node{index}" for index in range(len(nodes))]
+        self.healthy = [True] * len(nodes)
+        self.replicas = replicas or []
+        self.replica_names = replica_names or [f"replica{index}" for index in range(len(self.replicas))]
+        self.replica_healthy = [True] * len(self.replicas)
+        self.failovers = 0
+        # Muda a cada saída / retorno de nó (o barramento de invalidação resincroniza)
+        self.topology = 0
+        self.pool_exhaustions = 0
+        self._direct: Optional[redis.Redis] = None
+        self._direct_address: Optional[Tuple[str, int]] = None
+        points = []
+        if len(nodes) > 1:
+            # Pontos derivados do nome (host:porta): o anel é o mesmo em todas as réplicas
+            points = sorted(
+                (hash64(f"{name}#{vnode}".encode()), index)
+                for index, name in enumerate(self.names) for vnode in range(vnodes)
+            )
+        self._hashes = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+    
+    def node_index(self, key: str) -> int:
+        """Índice do nó responsável pela chave (desviando de nós indisponíveis)"""
+        if len(self.nodes) == 1:
+            return 0
+        position = bisect.bisect(self._hashes, hash64(key.encode())) % len(self._hashes)
+        owner = self._owners[position]
+        if self.healthy[owner]:
+            return owner
+        for offset in range(1, len(self._owners)):
+            index = self._owners[(position + offset) % len(self._owners)]
+            if self.healthy[index]:
+                return index
+        return owner
+    
+    def node_for(self, key: str) -> redis.Redis:
+        """Cliente do nó responsável pela chave"""
+        return self.nodes[self.node_index(key)]
+    
+    def reader(self, index: int) -> redis.Redis:
+        """Cliente para leituras do nó: uma réplica saudável, se houver, ou o próprio nó"""
+        replicas = [replica for replica, healthy in zip(self.replicas, self.replica_healthy) if healthy]
+        if replicas:
+            return random.choice(replicas)
+        return self.nodes[index]
+    
+    def reader_for(self, key: str) -> redis.Redis:
+        """Cliente para leituras da chave"""
+        return self.reader(self.node_index(key))
+    
+    def replica_read(self, client: redis.Redis) -> bool:
+        """Leituras neste cliente podem vir de uma réplica (atrasada em relação ao primário)"""
+        return client in self.replicas or (isinstance(client, redis.RedisCluster) and client.read_from_replicas)
+    
+    def group(self, keys: List[str]) -> Dict[int, List[str]]:
+        """Agrupa chaves por nó, para um pipeline por nó"""
+        groups: Dict[int, List[str]] = {}
+        for key in keys:
+            groups.setdefault(self.node_index(key), []).append(key)
+        return groups
+    
+    def available(self) -> List[redis.Redis]:
+        """Nós saudáveis (operações que varrem todos os nós)"""
+        return [node for node, healthy in zip(self.nodes, self.healthy) if healthy]
+    
+    def subscriber_for(self, key: str) -> redis.Redis:
+        """Cliente para Pub/Sub no nó da chave
+        
+        O RedisCluster assíncrono não tem Pub/Sub: usa uma conexão direta ao
+        primário do slot da chave, refeita quando o slot muda de dono.
+        """
+        node = self.node_for(key)
+        if not isinstance(node, redis.RedisCluster):
+            return node
+        primary = node.get_node_from_key(key)
+        if self._direct_address != (primary.host, primary.port):
+            if self._direct is not None:
+                run_in_background(self._direct.close())
+            self._direct = create_redis_client(primary.host, primary.port)
+            self._direct_address = (primary.host, primary.port)
+        return self._direct
+    
+    @staticmethod
+    def pool_exhausted(error: Exception) -> bool:
+        """Erro de pool de conexões esgotado no cliente (o nó em si está saudável)"""
+        return isinstance(error, MaxConnectionsError) or (
+            isinstance(error, redis.ConnectionError) and str(error) == "Too many connections"
+        )
+    
+    def report_failure(self, node: redis.Redis, error: Exception) -> None:
+        """Tira do anel um nó (ou réplica) que falhou por conexão ou timeout; o monitor o traz de volta"""
+        if not isinstance(error, (redis.ConnectionError, redis.TimeoutError)):
+            return
+        if self.pool_exhausted(error):
+            # Pool cheio é pressão local: tirar o nó do anel descartaria o cache dele na volta
+            self.pool_exhaustions += 1
+            return
+        if node in self.replicas:
+            index = self.replicas.index(node)
+            if self.replica_healthy[index]:
+                self.replica_healthy[index] = False
+                logger.warning("Réplica Redis indisponível, leituras desviadas", node=self.replica_names[index], error=str(error))
+            return
+        if len(self.nodes) == 1 or node not in self.nodes:
+            return
+        index = self.nodes.index(node)
+        if self.healthy[index]:
+            self.healthy[index] = False
+            self.failovers += 1
+            self.topology += 1
+            logger.warning("Nó Redis indisponível, chaves desviadas", node=self.names[index], error=str(error))
+    
+    async def monitor(self) -> None:
+        """Verifica periodicamente os nós e réplicas e reintegra os que voltaram"""
+        while True:
+            await asyncio.sleep(REDIS_HEALTH_CHECK_INTERVAL)
+            for index, replica in enumerate(self.replicas):
+                try:
+                    await replica.ping()
+                except Exception as e:
+                    self.report_failure(replica, e if isinstance(e, redis.RedisError) else redis.ConnectionError(str(e)))
+                    continue
+                if not self.replica_healthy[index]:
+                    # Réplicas não recebem escritas do gateway: nada a descartar
+                    self.replica_healthy[index] = True
+                    logger.info("Réplica Redis reintegrada", node=self.replica_names[index])
+            for index, node in enumerate(self.nodes):
+                try:
+                    await node.ping()
+                except Exception as e:
+                    self.report_failure(node, e if isinstance(e, redis.RedisError) else redis.ConnectionError(str(e)))
+                    continue
+                if not self.healthy[index]:
+                    try:
+                        await self._discard_entries(node)
+                    except Exception as e:
+                        logger.error("Erro ao descartar entradas do nó Redis", node=self.names[index], error=str(e))
+                        continue
+                    self.healthy[index] = True
+                    self.topology += 1
+                    logger.info("Nó Redis reintegrado ao anel", node=self.names[index])
+    
+    @staticmethod
+    async def _discard_entries(node: redis.Redis) -> None:
+        async for keys in scan_batches(node, "gateway_cache:*"):
+            if keys:
+                await node.unlink(*keys)
+        # A sequência do barramento fica: os assinantes resincronizam com o valor deste nó
+        await node.unlink(GENERATIONS_KEY)
+    
+    async def close(self) -> None:
+        """Fecha os clientes de todos os nós e réplicas"""
+        for node in self.nodes + self.replicas + ([self._direct] if self._direct is not None else []):
+            await node.close()
+            if not isinstance(node, redis.RedisCluster):
+                await node.connection_pool.disconnect()
+    
+    def stats(self) -> Dict:
+        """Estado dos nós do anel"""
+        return {
+            "mode": "cluster" if REDIS_CLUSTER else "ring" if len(self.nodes) > 1 else "single",
+            "nodes": [
+                {"node": name, "healthy": healthy} for name, healthy in zip(self.names, self.healthy)
+            ],
+            "replicas": [
+                {"node": name, "healthy": healthy} for name, healthy in zip(self.replica_names, self.replica_healthy)
+            ],
+            "read_from_replicas": REDIS_READ_FROM_REPLICAS,
+            "vnodes": len(self._hashes) // len(self.nodes) if self._hashes else 0,
+            "failovers": self.failovers,
+            "pool_exhaustions": self.pool_exhaustions
         }
-        key_string = json.dumps(key_data, sort_keys=True)
-        return f"gateway_cache:{hashlib.md5(key_string.encode()).hexdigest()}"
+
+class RedisBatcher:
+    """Micro-batching dos comandos de cache entre requisições concorrentes
+    
+    Comandos enviados ao mesmo nó no mesmo tick do event loop (ou dentro de
+    REDIS_BATCH_WINDOW_MS) seguem em um único pipeline; cada chamador recebe
+    só as próprias respostas e os próprios erros.
+    """
+    
+    def __init__(self, window_ms: float = REDIS_BATCH_WINDOW_MS, max_size: int = REDIS_BATCH_MAX_SIZE):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        # id do nó -> (nó, itens pendentes, timer do flush)
+        self._pending: Dict[int, Tuple[redis.Redis, List, asyncio.Handle]] = {}
+        self.batches = 0
+        self.commands = 0
+        self.callers = 0
+        self.max_batch_size = 0
+        self.wait_seconds = 0.0
+        self.roundtrip_seconds = 0.0
+    
+    async def execute(self, node: redis.Redis, commands: List[Tuple[str, tuple, dict]]) -> List:
+        """Enfileira os comandos (nome do método, args, kwargs) e aguarda as respostas"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.get(id(node))
+        if pending is None:
+            if self.window > 0:
+                handle = loop.call_later(self.window, self._flush, id(node))
+            else:
+                handle = loop.call_soon(self._flush, id(node))
+            pending = self._pending[id(node)] = (node, [], handle)
+        pending[1].append((commands, future, time.perf_counter()))
+        if sum(len(item[0]) for item in pending[1]) >= self.max_size:
+            pending[2].cancel()
+            self._flush(id(node))
+        replies = await future
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
     
-    async def get(self, key: str) -> Optional[Dict]:
-        """Recupera dados do cache"""
+    def _flush(self, node_id: int) -> None:
+        pending = self._pending.pop(node_id, None)
+        if pending is not None:
+            run_in_background(self._send(pending[0], pending[1]))
+    
+    async def _send(self, node: redis.Redis, items: List) -> None:
+        started = time.perf_counter()
+        size = 0
         try:
-            cached_data = await self.redis.get(key)
+            async with node.pipeline(transaction=False) as pipe:
+                for commands, _, _ in items:
+                    for name, args, kwargs in commands:
+                        getattr(pipe, name)(*args, **kwargs)
+                        size += 1
+                replies = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.batches += 1
+            self.commands += size
+            self.callers += len(items)
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.wait_seconds += sum(started - queued_at for _, _, queued_at in items)
+            self.roundtrip_seconds += time.perf_counter() - started
+        offset = 0
+        for commands, future, _ in items:
+            # Chamador cancelado: as respostas dele são descartadas
+            if not future.done():
+                future.set_result(replies[offset:offset + len(commands)])
+            offset += len(commands)
+    
+    def stats(self) -> Dict:
+        """Tamanho dos lotes e latência acrescentada pela espera na fila"""
+        return {
+            "enabled": True,
+            "window_ms": self.window * 1000,
+            "max_size": self.max_size,
+            "batches": self.batches,
+            "commands": self.commands,
+            "avg_batch_size": round(self.commands / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "avg_callers_per_batch": round(self.callers / self.batches, 2) if self.batches else 0.0,
+            "avg_wait_ms": round(self.wait_seconds / self.callers * 1000, 3) if self.callers else 0.0,
+            "avg_roundtrip_ms": round(self.roundtrip_seconds / self.batches * 1000, 3) if self.batches else 0.0
+        }
+
+# Micro-batching dos comandos do cache neste processo
+redis_batcher: Optional[RedisBatcher] = RedisBatcher() if REDIS_BATCHING else None
+
+class RedisLatencyGuard:
+    """Acompanha a latência das operações do cache (EWMA) e decide quando pular o Redis
+    
+    Acima de REDIS_SLOW_THRESHOLD_MS, as requisições deixam de esperar pelo
+    Redis e seguem direto ao upstream; uma operação por
+    REDIS_BYPASS_PROBE_INTERVAL ainda passa para medir a recuperação.
+    """
+    
+    def __init__(
+        self,
+        threshold_ms: float = REDIS_SLOW_THRESHOLD_MS,
+        alpha: float = REDIS_LATENCY_ALPHA,
+        probe_interval: float = REDIS_BYPASS_PROBE_INTERVAL
+    ):
+        self.threshold = threshold_ms / 1000
+        self.alpha = alpha
+        self.probe_interval = probe_interval
+        self.ewma = 0.0
+        self.max_latency = 0.0
+        self.operations = 0
+        self.timeouts = 0
+        self.bypassed = 0
+        self.probes = 0
+        self._probed_at = float("-inf")
+    
+    def observe(self, seconds: float) -> None:
+        """Registra a latência de uma operação (timeouts entram com o prazo estourado)"""
+        self.operations += 1
+        # Começa em zero: a primeira operação (conexão, carga de scripts) não dispara o desvio sozinha
+        self.ewma = self.alpha * seconds + (1 - self.alpha) * self.ewma
+        self.max_latency = max(self.max_latency, seconds)
+    
+    @property
+    def slow(self) -> bool:
+        return self.ewma > self.threshold
+    
+    def should_bypass(self) -> bool:
+        """Indica se a operação deve pular o Redis; deixa passar uma sondagem por intervalo"""
+        if not self.slow:
+            return False
+        now = time.monotonic()
+        if now - self._probed_at >= self.probe_interval:
+            self._probed_at = now
+            self.probes += 1
+            return False
+        self.bypassed += 1
+        return True
+    
+    def stats(self) -> Dict:
+        """Latência média e contadores de timeouts e desvios"""
+        return {
+            "enabled": True,
+            "ewma_ms": round(self.ewma * 1000, 3),
+            "max_ms": round(self.max_latency * 1000, 3),
+            "threshold_ms": self.threshold * 1000,
+            "op_timeout_ms": REDIS_OP_TIMEOUT_MS,
+            "slow": self.slow,
+            "operations": self.operations,
+            "timeouts": self.timeouts,
+            "bypassed": self.bypassed,
+            "probes": self.probes
+        }
+
+# Latência das operações do cache neste processo
+redis_latency: Optional[RedisLatencyGuard] = RedisLatencyGuard() if REDIS_LATENCY_GUARD else None
+
+class CacheService:
+    """Serviço de cache com Redis (um nó ou vários, distribuídos pelo RedisRing)"""
+    
+    def __init__(self, redis_client: Union[redis.Redis, RedisRing], local: Optional[LocalCache] = None):
+        self.ring = redis_client if isinstance(redis_client, RedisRing) else RedisRing([redis_client])
+        self.local = local
+    
+    def _generate_cache_key(
+        self,
+        method: str,
+        url: str,
+        params: QueryParams = None,
+        body: Any = None,
+        namespace: str = "",
+        defaults: Optional[Dict[str, str]] = None,
+        vary: Optional[List[Tuple[str, str]]] = None,
+        ignored: frozenset = frozenset()
+    ) -> str:
+        """Gera chave única para cache a partir da forma canônica da requisição"""
+        key_string = f"{method.upper()}\x00{canonical_url(url)}\x00{canonical_query(params, defaults, ignored)}"
+        if body is not None:
+            key_string += "\x00" + json.dumps(body, sort_keys=True)
+        if vary:
+            key_string += "\x00" + repr(vary)
+        digest = hash128(key_string.encode())
+        key = f"gateway_cache:{namespace}:{digest}" if namespace else f"gateway_cache:{digest}"
+        if REDIS_CLUSTER:
+            # Hash tag com 256 buckets: entrada, lock e índices de tag da entrada no mesmo slot
+            return f"{key}:{{{digest[:2]}}}"
+        return key
+    
+    async def namespace(self, service: str, path: str) -> Optional[str]:
+        """Namespace versionado da rota: serviço + gerações do serviço e do prefixo
+        
+        Ao incrementar uma geração, todas as chaves do namespace antigo deixam
+        de ser consultadas e expiram sozinhas pelo TTL / allkeys-lru. Sem
+        geração conhecida (Redis indisponível e nada em memória) retorna None:
+        um namespace inventado não seria alcançado pelas invalidações.
+        """
+        fields = namespace_generations.fields(service, path)
+        generations = [namespace_generations.get_local(field) for field in fields]
+        if None in generations and self._bypass():
+            generations = [namespace_generations.last_known(field) for field in fields]
+        elif None in generations:
+            try:
+                values = await self._script(
+                    self.ring.node_for(GENERATIONS_KEY), GET_GENERATIONS_SCRIPT,
+                    [GENERATIONS_KEY], [int(time.time() * 1000), *fields]
+                )
+                generations = [int(value) for value in values]
+                for field, generation in zip(fields, generations):
+                    namespace_generations.set_local(field, generation)
+            except Exception as e:
+                logger.error("Erro ao obter gerações de namespace", service=service, error=str(e))
+                generations = [namespace_generations.last_known(field) for field in fields]
+        if None in generations:
+            cache_metrics["namespace_unavailable"] += 1
+            return None
+        return f"{service}:{generations[0]:x}.{generations[1]:x}"
+    
+    async def bump_namespace(self, service: str, prefix: Optional[str] = None) -> int:
+        """Invalida em O(1) todas as entradas de um serviço ou de um prefixo de rota"""
+        field = service if prefix is None else f"{service}:{route_prefix(prefix)}"
+        generation = await BUMP_GENERATION_SCRIPT(
+            keys=[GENERATIONS_KEY], args=[field, int(time.time() * 1000)], client=self.ring.node_for(GENERATIONS_KEY)
+        )
+        namespace_generations.set_local(field, int(generation))
+        await self._publish({"type": "namespace", "field": field, "generation": int(generation)})
+        logger.info("Namespace invalidado", field=field, generation=generation)
+        return int(generation)
+    
+    async def get(self, key: str, local: bool = True) -> Optional[Dict]:
+        """Recupera dados do cache (L1 em memória, depois Redis; só Redis com `local=False`)"""
+        if local and self.local is not None:
+            cached = self.local.get(key)
+            if cached is not None:
+                return cached
+        
+        if self._bypass():
+            return None
+        
+        # Leitura em réplica quando configurada; escritas seguem para o primário
+        node = self.ring.reader_for(key)
+        try:
+            if self.local is None:
+                cached_data = await self._call(node, "get", key)
+            else:
+                # GET e PTTL no mesmo round-trip para limitar o TTL do L1
+                generation = tracking_invalidator.generation if tracking_invalidator is not None else 0
+                cached_data, pttl = (await self._run(node, self._read_commands(key)))[-2:]
             if cached_data:
-                return json.loads(cached_data)
+                cache_metrics["redis_hits"] += 1
+                entry = decode_entry(cached_data)
+                # Réplica atrasada pode devolver uma entrada já removida no primário (e já tirada
+                # do L1 pelo barramento): o L1 só é preenchido com leituras do primário
+                if self.local is not None and pttl > 0 and not self.ring.replica_read(node) and not (
+                    tracking_invalidator is not None and tracking_invalidator.invalidated_since(key, generation)
+                ):
+                    self.local.set(key, entry, len(cached_data), pttl / 1000)
+                return entry
+            cache_metrics["redis_misses"] += 1
         except Exception as e:
             logger.error("Erro ao recuperar cache", key=key, error=str(e))
+            self.ring.report_failure(node, e)
         return None
     
-    async def set(self, key: str, data: Dict, ttl: int = CACHE_TTL) -> bool:
-        """Armazena dados no cache"""
+    @staticmethod
+    def _read_commands(key: str, primary: Optional[redis.Redis] = None) -> List[Tuple[str, tuple, dict]]:
+        """GET e PTTL da chave (no primário, se informado); no tracking "optin", precedidos de CLIENT CACHING YES"""
+        if primary is not None:
+            commands = [primary_command(primary, "get", key), primary_command(primary, "pttl", key)]
+        else:
+            commands = [("get", (key,), {}), ("pttl", (key,), {})]
+        if tracking_invalidator is not None and L1_TRACKING_MODE == "optin":
+            commands.insert(0, ("execute_command", ("CLIENT", "CACHING", "YES"), {}))
+        return commands
+    
+    @staticmethod
+    def _bypass() -> bool:
+        """Redis lento: a operação é pulada (a requisição segue como miss)"""
+        return redis_latency is not None and redis_latency.should_bypass()
+    
+    @classmethod
+    async def _call(cls, node: redis.Redis, name: str, *args, **kwargs) -> Any:
+        """Executa um comando, no lote de outras requisições quando há micro-batching"""
+        if redis_batcher is None:
+            return await cls._deadline(getattr(node, name)(*args, **kwargs))
+        return (await cls._deadline(redis_batcher.execute(node, [(name, args, kwargs)])))[0]
+    
+    @classmethod
+    async def _script(cls, node: redis.Redis, script: AsyncScript, keys: List, args: List) -> Any:
+        """Executa um script por EVALSHA (no lote, se houver); se o nó ainda não o tem, o EVAL o carrega"""
+        try:
+            return await cls._call(node, "evalsha", script.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return await cls._call(node, "eval", script.script, len(keys), *keys, *args)
+    
+    @classmethod
+    async def _run(
+        cls,
+        node: redis.Redis,
+        commands: List[Tuple[str, tuple, dict]],
+        deadline: bool = True
+    ) -> List:
+        """Executa comandos em um round-trip (pipeline próprio ou lote compartilhado)"""
+        if redis_batcher is not None:
+            operation = redis_batcher.execute(node, commands)
+        else:
+            operation = cls._pipeline(node, commands)
+        return await cls._deadline(operation) if deadline else await operation
+    
+    @staticmethod
+    async def _pipeline(node: redis.Redis, commands: List[Tuple[str, tuple, dict]]) -> List:
+        async with node.pipeline(transaction=False) as pipe:
+            for name, args, kwargs in commands:
+                getattr(pipe, name)(*args, **kwargs)
+            return await pipe.execute()
+    
+    @staticmethod
+    async def _deadline(operation) -> Any:
+        """Aplica REDIS_OP_TIMEOUT_MS à operação e registra sua latência"""
+        started = time.perf_counter()
         try:
-            await self.redis.setex(key, ttl, json.dumps(data))
+            return await asyncio.wait_for(operation, REDIS_OP_TIMEOUT_MS / 1000)
+        except asyncio.TimeoutError:
+            if redis_latency is not None:
+                redis_latency.timeouts += 1
+            # Não é falha de conexão: o nó continua no anel
+            raise asyncio.TimeoutError(f"Operação Redis excedeu {REDIS_OP_TIMEOUT_MS:g} ms")
+        finally:
+            if redis_latency is not None:
+                redis_latency.observe(time.perf_counter() - started)
+    
+    async def reload_pinned(self) -> int:
+        """Recarrega do Redis as chaves fixadas no L1; chaves frias ou removidas deixam de ser fixadas"""
+        if self.local is None or not self.local.pinned:
+            return 0
+        generation = tracking_invalidator.generation if tracking_invalidator is not None else 0
+        keys = []
+        replies = []
+        # Um pipeline por nó do anel, lendo do primário (o resultado vai para o L1)
+        for index, node_keys in self.ring.group(list(self.local.pinned)).items():
+            node = self.ring.nodes[index]
+            # Fora do caminho das requisições: sem o prazo por operação
+            replies.extend(await self._run(
+                node, [command for key in node_keys for command in self._read_commands(key, node)],
+                deadline=False
+            ))
+            keys.extend(node_keys)
+        # Cada chave ocupa GET + PTTL no pipeline, precedidos de CLIENT CACHING no modo optin
+        stride = len(replies) // len(keys)
+        reloaded = 0
+        for index, key in enumerate(keys):
+            cached_data, pttl = replies[stride * index + stride - 2:stride * (index + 1)]
+            if not cached_data or pttl <= 0 or hot_keys is None or not hot_keys.is_hot(key):
+                self.local.unpin(key)
+                if not cached_data:
+                    self.local.delete(key)
+                continue
+            if tracking_invalidator is not None and tracking_invalidator.invalidated_since(key, generation):
+                continue
+            self.local.set(key, decode_entry(cached_data), len(cached_data), pttl / 1000)
+            reloaded += 1
+        return reloaded
+    
+    async def set(
+        self,
+        key: str,
+        entry: Dict,
+        ttl: float = CACHE_TTL,
+        stale_ttl: float = CACHE_STALE_TTL,
+        tags: List[str] = None,
+        compress: bool = True
+    ) -> bool:
+        """Armazena uma resposta no cache
+        
+        A entrada (status_code, headers, timestamp e corpo bruto) fica fresca por `ttl` segundos (TTL soft) e permanece no Redis
+        por mais `stale_ttl` segundos (TTL hard) para ser servida como STALE. Frações de segundo
+        são respeitadas (micro-cache de erros) e o TTL soft recebe jitter (CACHE_TTL_JITTER).
+        Corpos a partir de CACHE_COMPRESSION_MIN_SIZE bytes são comprimidos.
+        Com `tags`, a chave é registrada no índice de cada tag na mesma operação
+        (os índices de tag ficam no mesmo nó da entrada).
+        """
+        if self._bypass():
+            return False
+        node = self.ring.node_for(key)
+        try:
+            ttl = self.jittered(ttl)
+            entry["expires_at"] = time.time() + ttl
+            body_size = len(entry["body"])
+            if (compress and cache_codec is not None and entry.get("encoding") is None
+                    and body_size >= CACHE_COMPRESSION_MIN_SIZE):
+                compressed = compress_body(entry["body"], cache_codec)
+                if len(compressed) < body_size:
+                    entry["body"] = compressed
+                    entry["encoding"] = cache_codec
+                    cache_metrics["compressed_entries"] += 1
+            payload = encode_entry(entry)
+            hard_ttl_ms = max(1, int((ttl + stale_ttl) * 1000))
+            if tags:
+                entry_tag_keys = [tag_key(tag, key) for tag in tags]
+                oversized = await self._script(
+                    node, SET_WITH_TAGS_SCRIPT, [key, *entry_tag_keys], [payload, hard_ttl_ms, TAG_COMPACT_THRESHOLD]
+                )
+                for oversized_key in oversized:
+                    self._schedule_compaction(oversized_key.decode(), node)
+            else:
+                await self._call(node, "set", key, payload, px=hard_ttl_ms)
+            # Com tracking, a própria escrita volta como invalidação: o L1 é preenchido na próxima leitura
+            if self.local is not None and tracking_invalidator is None:
+                self.local.set(key, entry, len(payload), ttl + stale_ttl)
+            cache_metrics["stored_entries"] += 1
+            cache_metrics["stored_body_bytes"] += body_size
+            cache_metrics["stored_bytes"] += len(payload)
             return True
         except Exception as e:
             logger.error("Erro ao armazenar cache", key=key, error=str(e))
+            self.ring.report_failure(node, e)
             return False
     
-    async def delete(self, pattern: str) -> int:
-        """Remove chaves do cache por padrão"""
+    async def refresh(
+        self,
+        key: str,
+        entry: Dict,
+        ttl: float = CACHE_TTL,
+        stale_ttl: float = CACHE_STALE_TTL,
+        age: int = 0,
+        tags: List[str] = None
+    ) -> bool:
+        """Renova uma entrada revalidada pelo upstream (304) sem regravar o corpo
+        
+        Só a criação e a expiração soft do envelope são reescritas (SETRANGE) e
+        o TTL da chave e das tags é renovado. Entradas no formato legado ou já
+        removidas do Redis são regravadas inteiras.
+        """
+        soft_ttl = self.jittered(ttl)
+        now = time.time()
+        entry["timestamp"] = now - age
+        entry["expires_at"] = now + soft_ttl
+        hard_ttl_ms = max(1, int((soft_ttl + stale_ttl) * 1000))
+        entry_tag_keys = [tag_key(tag, key) for tag in tags or []]
+        stamps = ENVELOPE_TIMESTAMPS.pack(int(entry["timestamp"] * 1000), int(entry["expires_at"] * 1000))
+        node = self.ring.node_for(key)
+        try:
+            refreshed = await self._script(
+                node, REFRESH_ENTRY_SCRIPT, [key, *entry_tag_keys],
+                [ENVELOPE_MAGIC, ENVELOPE_TIMESTAMPS_OFFSET, stamps, hard_ttl_ms]
+            )
+        except Exception as e:
+            logger.error("Erro ao renovar cache", key=key, error=str(e))
+            self.ring.report_failure(node, e)
+            return False
+        if not refreshed:
+            # set() aplica o jitter sobre o TTL original
+            return await self.set(key, entry, ttl=ttl, stale_ttl=stale_ttl, tags=tags)
+        if self.local is not None:
+            # A próxima leitura traz do Redis a entrada com a nova expiração
+            self.local.delete(key)
+        cache_metrics["refreshed_entries"] += 1
+        return True
+    
+    @staticmethod
+    def is_stale(entry: Dict) -> bool:
+        """Indica se a entrada já passou do TTL soft"""
+        return entry.get("expires_at", float("inf")) <= time.time()
+    
+    @staticmethod
+    def jittered(ttl: float) -> float:
+        """Encurta o TTL soft em até CACHE_TTL_JITTER (fração) para espalhar as expirações"""
+        if CACHE_TTL_JITTER <= 0:
+            return ttl
+        return ttl * (1 - random.uniform(0, CACHE_TTL_JITTER))
+    
+    @staticmethod
+    def should_refresh_early(entry: Dict, beta: float = CACHE_EARLY_REFRESH_BETA) -> bool:
+        """XFetch: decide se um hit ainda fresco deve disparar a atualização antecipada
+        
+        A chance cresce conforme a expiração se aproxima e com a duração da
+        última busca upstream (fetch_time), para que entradas caras de refazer
+        sejam atualizadas mais cedo.
+        """
+        fetch_time = entry.get("fetch_time", 0)
+        if fetch_time <= 0:
+            return False
+        # 1 - random() está em (0, 1]: evita log(0)
+        return time.time() - fetch_time * beta * math.log(1 - random.random()) >= entry["expires_at"]
+    
+    async def acquire_lock(self, key: str, ttl: float = SINGLE_FLIGHT_LOCK_TTL) -> Optional[str]:
+        """Tenta obter lock distribuído para a chave; retorna o token ou None"""
+        token = secrets.token_hex(8)
+        if self._bypass():
+            # Redis lento: a coordenação fica com o single-flight local
+            return token
         try:
-            keys = await self.redis.keys(pattern)
+            if await self._call(self.ring.node_for(key), "set", f"{key}:lock", token, nx=True, px=int(ttl * 1000)):
+                return token
+        except Exception as e:
+            logger.error("Erro ao obter lock", key=key, error=str(e))
+            # Sem Redis não há como coordenar réplicas: segue como dono do lock
+            return token
+        return None
+    
+    async def release_lock(self, key: str, token: str) -> None:
+        """Libera o lock somente se ainda pertencer a este token"""
+        if self._bypass():
+            # Redis lento: um lock obtido antes expira pelo TTL
+            return
+        try:
+            await self._script(self.ring.node_for(key), RELEASE_LOCK_SCRIPT, [f"{key}:lock"], [token])
+        except Exception as e:
+            logger.error("Erro ao liberar lock", key=key, error=str(e))
+    
+    async def _publish(self, event: Dict) -> None:
+        """Propaga a invalidação às outras réplicas"""
+        if invalidation_bus is not None:
+            await invalidation_bus.publish(self.ring.node_for(INVALIDATION_SEQ_KEY), event)
+    
+    async def invalidate_tags(self, tags: List[str]) -> int:
+        """Remove todas as entradas associadas às tags
+        
+        O set da tag é renomeado antes da remoção: entradas gravadas durante a
+        invalidação entram em um set novo e não são perdidas nem misturadas.
+        Cada nó do anel tem o seu set da tag (no Redis Cluster, um por bucket de slot).
+        """
+        deleted = 0
+        for tag in tags:
+            for node in self.ring.available():
+                for key in await self._existing_tag_keys(node, tag):
+                    deleted += await self._invalidate_tag_key(node, key)
+        cache_metrics["tag_invalidations"] += len(tags)
+        return deleted
+    
+    @staticmethod
+    async def _existing_tag_keys(node: redis.Redis, tag: str) -> List[str]:
+        candidates = tag_keys(tag)
+        if len(candidates) == 1:
+            return candidates
+        # Buckets do cluster: um EXISTS por bucket, agrupados por nó no pipeline do cluster;
+        # sempre no primário (um bucket recém-criado pode não ter chegado à réplica)
+        exists = await CacheService._pipeline(node, [primary_command(node, "exists", key) for key in candidates])
+        return [key for key, found in zip(candidates, exists) if found]
+    
+    async def _invalidate_tag_key(self, node: redis.Redis, tag_key: str) -> int:
+        # Snapshot com o mesmo sufixo: continua no slot do set original
+        snapshot_key = f"{tag_key}:invalidating:{secrets.token_hex(4)}"
+        if REDIS_CLUSTER:
+            snapshot_key += tag_key[tag_key.rfind("{"):]
+        try:
+            await node.rename(tag_key, snapshot_key)
+        except redis.ResponseError:
+            # Set inexistente: nenhuma entrada com a tag neste nó
+            return 0
+        
+        deleted = 0
+        cursor = 0
+        while True:
+            cursor, keys = await node.sscan(snapshot_key, cursor=cursor, count=INVALIDATION_SCAN_COUNT)
             if keys:
-                return await self.redis.delete(*keys)
+                deleted += await node.unlink(*keys)
+                keys = [key.decode() for key in keys]
+                if self.local is not None:
+                    for key in keys:
+                        self.local.delete(key)
+                await self._publish({"type": "keys", "keys": keys})
+            if cursor == 0:
+                break
+        await node.unlink(snapshot_key)
+        return deleted
+    
+    def _schedule_compaction(self, tag_key: str, node: redis.Redis) -> None:
+        now = time.monotonic()
+        compaction_key = f"{self.ring.names[self.ring.nodes.index(node)]}/{tag_key}"
+        if now - tag_compactions.get(compaction_key, float("-inf")) < TAG_COMPACT_INTERVAL:
+            return
+        tag_compactions[compaction_key] = now
+        run_in_background(self.compact_tag(tag_key, node))
+    
+    async def compact_tag(self, tag_key: str, node: Optional[redis.Redis] = None) -> int:
+        """Remove do set da tag as chaves que já expiraram ou foram removidas (em um nó ou em todos)"""
+        removed = 0
+        try:
+            for node in [node] if node is not None else self.ring.available():
+                cursor = 0
+                while True:
+                    cursor, keys = await node.sscan(tag_key, cursor=cursor, count=INVALIDATION_SCAN_COUNT)
+                    if keys:
+                        # Script roda no primário: a réplica pode ainda não ter a chave
+                        removed += await COMPACT_TAG_SCRIPT(keys=[tag_key, *keys], client=node)
+                    if cursor == 0:
+                        break
+                    await asyncio.sleep(0)
+            logger.info("Set de tag compactado", tag_key=tag_key, removed=removed)
+        except Exception as e:
+            logger.error("Erro ao compactar set de tag", tag_key=tag_key, error=str(e))
+        return removed
+    
+    async def delete(self, pattern: str, job: Optional["InvalidationJob"] = None) -> int:
+        """Remove chaves do cache por padrão"""
+        try:
+            return await self.delete_incremental(pattern, job)
         except Exception as e:
             logger.error("Erro ao deletar cache", pattern=pattern, error=str(e))
-        return 0
+        return job.deleted if job is not None else 0
+    
+    async def delete_incremental(self, pattern: str, job: Optional["InvalidationJob"] = None) -> int:
+        """Remove chaves por padrão com cursores SCAN e UNLINK em lotes
+        
+        Diferente de KEYS + DEL, nenhum comando bloqueia o Redis por muito tempo:
+        cada lote varre no máximo INVALIDATION_SCAN_COUNT chaves e a memória é
+        liberada em background pelo UNLINK. Cada nó do anel é varrido por
+        vez (no Redis Cluster, cada primário). Erros são propagados.
+        """
+        if self.local is not None:
+            self.local.delete_pattern(pattern)
+        
+        # Chave exata: não há o que varrer
+        if not any(char in pattern for char in "*?["):
+            deleted = await self.ring.node_for(pattern).unlink(pattern)
+            if job is not None:
+                job.record_batch(1, deleted)
+            await self._publish({"type": "keys", "keys": [pattern]})
+            return deleted
+        
+        deleted = 0
+        for node in self.ring.available():
+            async for keys in scan_batches(node, pattern):
+                batch_deleted = await node.unlink(*keys) if keys else 0
+                deleted += batch_deleted
+                if job is not None:
+                    job.record_batch(len(keys), batch_deleted)
+                # Devolve o controle ao event loop entre lotes (e permite cancelamento)
+                await asyncio.sleep(INVALIDATION_BATCH_PAUSE)
+        # Réplicas só descartam suas cópias depois que o Redis não tem mais as chaves
+        await self._publish({"type": "pattern", "pattern": pattern})
+        return deleted
+
+class InvalidationJob:
+    """Job de invalidação por padrão executado em background, com progresso e cancelamento"""
+    
+    def __init__(self, pattern: str):
+        self.id = secrets.token_hex(8)
+        self.pattern = pattern
+        self.status = "pending"
+        self.scanned = 0
+        self.deleted = 0
+        self.batches = 0
+        self.error: Optional[str] = None
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self, cache_service: CacheService) -> "InvalidationJob":
+        """Inicia o job em background"""
+        self._task = run_in_background(self._run(cache_service))
+        return self
+    
+    async def wait(self) -> "InvalidationJob":
+        """Aguarda o fim do job"""
+        if self._task is not None:
+            await asyncio.shield(self._task)
+        return self
+    
+    def cancel(self) -> bool:
+        """Cancela o job se ainda estiver em execução"""
+        if self._task is None or self._task.done():
+            return False
+        self._task.cancel()
+        return True
+    
+    def record_batch(self, scanned: int, deleted: int) -> None:
+        self.batches += 1
+        self.scanned += scanned
+        self.deleted += deleted
+    
+    async def _run(self, cache_service: CacheService) -> None:
+        self.status = "running"
+        try:
+            await cache_service.delete_incremental(self.pattern, self)
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+        except Exception as e:
+            logger.error("Erro no job de invalidação", pattern=self.pattern, error=str(e))
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            self.finished_at = datetime.utcnow()
+            logger.info("Job de invalidação finalizado", job_id=self.id, status=self.status,
+                        pattern=self.pattern, deleted=self.deleted)
+    
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "pattern": self.pattern,
+            "status": self.status,
+            "scanned": self.scanned,
+            "deleted": self.deleted,
+            "batches": self.batches,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+# Jobs de invalidação recentes (mais antigos são descartados)
+invalidation_jobs: "OrderedDict[str, InvalidationJob]" = OrderedDict()
+
+def start_invalidation_job(pattern: str, cache_service: CacheService) -> InvalidationJob:
+    """Cria, registra e inicia um job de invalidação"""
+    job = InvalidationJob(pattern).start(cache_service)
+    invalidation_jobs[job.id] = job
+    while len(invalidation_jobs) > INVALIDATION_JOBS_HISTORY:
+        invalidation_jobs.popitem(last=False)
+    return job
 
 class ProxyService:
     """Serviço de proxy para APIs externas"""
@@ -116,7 +2519,7 @@ class ProxyService:
         service: str, 
         path: str, 
         method: str, 
-        params: Dict = None, 
+        params: QueryParams = None, 
         json_data: Any = None,
         headers: Dict = None
     ) -> Dict:
@@ -127,22 +2530,362 @@ class ProxyService:
         
         target_url = f"{self.service_urls[service]}{path}"
         
+        if method.upper() != "GET":
+            result = await self._fetch(service, target_url, method, params, json_data, headers)
+            if 200 <= result["status_code"] < 300:
+                await self.invalidate_for_mutation(service, method, path)
+            return result
+        
         # Verificar cache para métodos GET
-        if method.upper() == "GET":
-            cache_key = self.cache._generate_cache_key(method, target_url, params)
-            cached_response = await self.cache.get(cache_key)
-            if cached_response:
+        policy, route_params = cache_policy.match(service, path)
+        if policy.bypass:
+            result = await self._fetch(service, target_url, method, params, json_data, headers)
+            return {**result, "cache_status": "BYPASS"}
+        
+        plan = await self._cache_plan(service, path, target_url, method, params, headers, policy, route_params)
+        if plan is None:
+            # Credenciais em rota que não varia por elas (nunca compartilhar) ou geração de namespace desconhecida
+            result = await self._fetch(service, target_url, method, params, json_data, headers)
+            return {**result, "cache_status": "BYPASS"}
+        
+        cached_response = await self.cache.get(plan["key"])
+        stale_response = None
+        if cached_response:
+            if not self.cache.is_stale(cached_response):
                 logger.info("Cache hit", url=target_url, method=method)
-                return {
-                    "data": cached_response["data"],
-                    "cached": True,
-                    "cache_timestamp": cached_response["timestamp"]
-                }
+                if hot_keys is not None and hot_keys.record(plan["key"]) and self.cache.local is not None:
+                    # Chave quente: fica no L1 sem eviction e é recarregada do Redis em background
+                    self.cache.local.pin(plan["key"])
+                if (CACHE_EARLY_REFRESH and cached_response["status_code"] < 400
+                        and self.cache.should_refresh_early(cached_response)):
+                    cache_metrics["early_refreshes"] += 1
+                    run_in_background(self._revalidate(
+                        service, target_url, method, params, headers, {**plan, "stale": cached_response}
+                    ))
+                return self._cached_result(cached_response, request_headers=headers)
+            
+            # A busca revalida a cópia expirada com os validadores armazenados
+            plan["stale"] = cached_response
+            if CACHE_STALE_WHILE_REVALIDATE:
+                # Servir a cópia expirada imediatamente e atualizar em background
+                logger.info("Cache stale, revalidando em background", url=target_url, method=method)
+                run_in_background(self._revalidate(service, target_url, method, params, headers, plan))
+                return self._cached_result(cached_response, "STALE", headers)
+            stale_response = cached_response
+        
+        try:
+            result = await self._fetch_shared(service, target_url, method, params, json_data, headers, plan)
+        except HTTPException:
+            if stale_response is not None and CACHE_STALE_IF_ERROR:
+                logger.warning("Upstream indisponível, servindo cache stale", url=target_url)
+                return self._cached_result(stale_response, "STALE", headers)
+            raise
+        
+        if stale_response is not None:
+            if result["status_code"] >= 500 and CACHE_STALE_IF_ERROR:
+                logger.warning("Upstream com erro, servindo cache stale", url=target_url,
+                               status_code=result["status_code"])
+                return self._cached_result(stale_response, "STALE", headers)
+            result = {**result, "cache_status": "REVALIDATED"}
+        return result
+    
+    async def _cache_plan(
+        self,
+        service: str,
+        path: str,
+        target_url: str,
+        method: str,
+        params: QueryParams,
+        headers: Dict,
+        policy: RoutePolicy,
+        route_params: Dict[str, str]
+    ) -> Optional[Dict]:
+        """Chave, TTLs, tags e headers de variação da entrada de um GET; None se não for cacheável
+        
+        A chave base cobre URL e query; headers configurados na rota ou
+        aprendidos do Vary do upstream geram uma chave por variante.
+        """
+        headers = headers or {}
+        namespace = await self.cache.namespace(service, path)
+        if namespace is None:
+            # Geração desconhecida: nem leitura nem escrita no cache
+            return None
+        base_key = self.cache._generate_cache_key(
+            method, target_url, params, namespace=namespace,
+            defaults=policy.query_defaults, ignored=policy.ignore_params
+        )
+        specs = list(policy.vary)
+        learned = vary_registry.get(base_key)
+        specs += [(name, None) for name in sorted(learned) if not any(name == spec[0] for spec in specs)]
+        vary_names = frozenset(name for name, _ in specs)
+        if "authorization" in headers and "authorization" not in vary_names:
+            cache_metrics["private_bypass"] += 1
+            return None
+        
+        key = base_key
+        if specs:
+            key = self.cache._generate_cache_key(
+                method, target_url, params, namespace=namespace, defaults=policy.query_defaults,
+                vary=vary_values(specs, headers), ignored=policy.ignore_params
+            )
+        tags = policy.tags_for(route_params, params)
+        if specs:
+            # Variantes têm chaves próprias: a tag implícita permite invalidar todas pela chave base
+            tags.append(variants_tag(base_key))
+        return {
+            "key": key,
+            "base_key": base_key,
+            "vary": vary_names,
+            "tags": tags,
+            "ttl": policy.ttl,
+            "stale_ttl": policy.stale_ttl,
+            "honor_cache_control": policy.honor_cache_control,
+            "negative_ttl": policy.negative_ttl,
+            "error_ttl": policy.error_ttl_ms / 1000,
+            "compress": policy.compression
+        }
+    
+    async def _fetch_shared(
+        self,
+        service: str,
+        target_url: str,
+        method: str,
+        params: QueryParams,
+        json_data: Any,
+        headers: Dict,
+        plan: Dict
+    ) -> Dict:
+        """Busca no upstream compartilhando a requisição entre misses concorrentes"""
+        if SINGLE_FLIGHT_MODE == "off":
+            return await self._fetch(service, target_url, method, params, json_data, headers, plan)
+        
+        # Misses concorrentes da mesma chave compartilham uma única busca
+        result, shared = await single_flight.do(
+            plan["key"],
+            lambda: self._fetch_coalesced(service, target_url, method, params, json_data, headers, plan)
+        )
+        if shared:
+            cache_metrics["coalesced_requests"] += 1
+            logger.info("Requisição coalescida", url=target_url, method=method)
+        return result
+    
+    async def _revalidate(
+        self,
+        service: str,
+        target_url: str,
+        method: str,
+        params: QueryParams,
+        headers: Dict,
+        plan: Dict
+    ) -> None:
+        """Atualiza uma entrada stale em background"""
+        try:
+            await self._fetch_shared(service, target_url, method, params, None, headers, plan)
+            cache_metrics["background_revalidations"] += 1
+        except Exception as e:
+            logger.error("Erro ao revalidar cache em background", url=target_url, error=str(e))
+    
+    async def invalidate_for_mutation(self, service: str, method: str, path: str) -> List[str]:
+        """Aplica as regras de invalidação para uma mutação bem-sucedida"""
+        targets = cache_policy.invalidation_targets(service, method, path)
+        for target in targets:
+            try:
+                await self._invalidate_target(service, target)
+                cache_metrics["mutation_invalidations"] += 1
+            except Exception as e:
+                logger.error("Erro ao invalidar cache após mutação", service=service, target=target, error=str(e))
+        if targets:
+            logger.info("Cache invalidado por mutação", service=service, method=method, path=path, targets=targets)
+        return targets
+    
+    async def _invalidate_target(self, service: str, target: str) -> None:
+        kind, _, value = target.partition(":")
+        if kind == "tag":
+            await self.cache.invalidate_tags([value])
+        elif kind == "service":
+            await self.cache.bump_namespace(service)
+        elif kind == "prefix":
+            await self.cache.bump_namespace(service, value)
+        elif kind == "path":
+            namespace = await self.cache.namespace(service, value)
+            if namespace is None:
+                raise RuntimeError("Gerações de namespace indisponíveis")
+            # Chave base com as regras da rota; variantes (vary da política ou aprendido) pela tag implícita
+            policy, _ = cache_policy.match(service, value)
+            base_key = self.cache._generate_cache_key(
+                "GET", f"{self.service_urls[service]}{value}", {}, namespace=namespace,
+                defaults=policy.query_defaults, ignored=policy.ignore_params
+            )
+            await self.cache.delete_incremental(base_key)
+            await self.cache.invalidate_tags([variants_tag(base_key)])
+        else:
+            logger.warning("Alvo de invalidação desconhecido", target=target)
+    
+    def _cached_result(
+        self,
+        cached_response: Dict,
+        cache_status: str = "HIT",
+        request_headers: Dict = None
+    ) -> Dict:
+        body = cached_response["body"]
+        if cached_response["status_code"] >= 400 and cache_status == "HIT":
+            cache_status = "NEGATIVE"
+            cache_metrics["negative_hits"] += 1
+        # Age: tempo desde a resposta original, para caches downstream descontarem do max-age
+        age = max(0, int(time.time() - cached_response["timestamp"]))
+        response_headers = {**cached_response["headers"], "age": str(age)}
+        result = {
+            "status_code": cached_response["status_code"],
+            "headers": response_headers,
+            "body": body,
+            "cached": True,
+            "cache_status": cache_status,
+            "cache_timestamp": cached_response["timestamp"]
+        }
+        encoding = cached_response.get("encoding")
+        passthrough = encoding is not None and accepts_encoding((request_headers or {}).get("accept-encoding"), encoding)
+        if encoding is not None:
+            response_headers["vary"] = merge_vary(response_headers.get("vary"), ["accept-encoding"])
+        if passthrough:
+            # Corpo comprimido vai direto ao cliente; a representação comprimida tem ETag próprio
+            response_headers["content-encoding"] = encoding
+            if response_headers.get("etag"):
+                response_headers["etag"] = encoded_etag(response_headers["etag"], encoding)
+        
+        if result["status_code"] == 200 and is_not_modified(request_headers, response_headers):
+            # 304 direto dos metadados da entrada, sem descomprimir nem enviar o corpo
+            return not_modified(result)
+        
+        if passthrough:
+            cache_metrics["compressed_passthrough"] += 1
+        elif encoding is not None:
+            result["body"] = decompress_body(body, encoding)
+        return result
+    
+    async def _fetch_coalesced(
+        self,
+        service: str,
+        target_url: str,
+        method: str,
+        params: QueryParams,
+        json_data: Any,
+        headers: Dict,
+        plan: Dict
+    ) -> Dict:
+        """Busca no upstream; no modo redis, coordena a busca entre réplicas com lock"""
+        if SINGLE_FLIGHT_MODE != "redis":
+            return await self._fetch(service, target_url, method, params, json_data, headers, plan)
+        
+        cache_key = plan["key"]
+        token = await self.cache.acquire_lock(cache_key)
+        if token is None:
+            # Outra réplica está buscando: aguardar o resultado aparecer no cache
+            deadline = time.monotonic() + SINGLE_FLIGHT_LOCK_TTL
+            while time.monotonic() < deadline:
+                await asyncio.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+                # Direto do Redis, ignorando a cópia expirada (que fica até o TTL hard, também no L1)
+                cached_response = await self.cache.get(cache_key, local=False)
+                if cached_response and not self.cache.is_stale(cached_response):
+                    cache_metrics["coalesced_requests"] += 1
+                    # Resultado compartilhado pelo single-flight: sem os headers do líder (304 e
+                    # codificação ficam para a rota de cada requisição)
+                    return self._cached_result(cached_response)
+            return await self._fetch(service, target_url, method, params, json_data, headers, plan)
+        
+        try:
+            return await self._fetch(service, target_url, method, params, json_data, headers, plan)
+        finally:
+            await self.cache.release_lock(cache_key, token)
+    
+    async def _store_negative(self, plan: Dict, response: httpx.Response, response_headers: Dict) -> None:
+        """Cache negativo: 404 / 410 por negative_ttl e 5xx por error_ttl (sem janela stale)"""
+        if response.status_code in NEGATIVE_CACHE_STATUSES:
+            ttl, metric = plan["negative_ttl"], "negative_stores"
+        elif response.status_code >= 500 and plan.get("stale") is None:
+            # Com uma cópia boa expirada, o erro não a substitui: ela segue disponível para stale-if-error
+            ttl, metric = plan["error_ttl"], "error_stores"
+        else:
+            return
+        if ttl <= 0 or "no-store" in parse_cache_control(response.headers.get("cache-control")):
+            return
+        if not self._cacheable_variant(plan, response):
+            return
+        entry = {
+            "status_code": response.status_code,
+            "headers": response_headers,
+            "timestamp": time.time(),
+            "body": response.content
+        }
+        await self.cache.set(plan["key"], entry, ttl=ttl, stale_ttl=0, tags=plan["tags"], compress=plan["compress"])
+        cache_metrics[metric] += 1
+    
+    async def _refresh_stale(self, plan: Dict, stale: Dict, response: httpx.Response) -> Dict:
+        """Entrada confirmada pelo upstream (304): renova o TTL e serve o corpo armazenado
         
-        # Fazer requisição para API externa
+        O resultado pode ser compartilhado entre requisições coalescidas, então
+        não depende dos headers de nenhuma delas (o condicional do cliente é
+        avaliado depois, na rota).
+        """
+        cache_metrics["upstream_not_modified"] += 1
+        freshness = (plan["ttl"], plan["stale_ttl"], 0)
+        if plan["honor_cache_control"]:
+            # Headers do 304 atualizam os armazenados (RFC 9111, seção 4.3.4)
+            headers = httpx.Headers(stale["headers"])
+            headers.update(response.headers)
+            freshness = upstream_freshness(headers, plan["ttl"], plan["stale_ttl"])
+        if freshness is not None:
+            ttl, stale_ttl, age = freshness
+            await self.cache.refresh(plan["key"], stale, ttl=ttl, stale_ttl=stale_ttl, age=age, tags=plan["tags"])
+        logger.info("Cache revalidado pelo upstream", key=plan["key"])
+        return self._cached_result(stale, "REVALIDATED")
+    
+    @staticmethod
+    def _cacheable_variant(plan: Dict, response: httpx.Response) -> bool:
+        """Confere o Vary do upstream contra os headers usados na chave
+        
+        Headers novos são registrados para a chave base e a resposta não é
+        armazenada: a próxima requisição já monta a chave com eles.
+        """
+        vary = parse_vary_header(response.headers.get("vary"))
+        if "*" in vary:
+            return False
+        if not vary <= plan["vary"]:
+            vary_registry.learn(plan["base_key"], vary)
+            logger.info("Vary aprendido do upstream", base_key=plan["base_key"], vary=sorted(vary))
+            return False
+        return True
+    
+    async def _fetch(
+        self,
+        service: str,
+        target_url: str,
+        method: str,
+        params: QueryParams = None,
+        json_data: Any = None,
+        headers: Dict = None,
+        plan: Optional[Dict] = None
+    ) -> Dict:
+        """Faz a requisição para a API externa e armazena em cache quando aplicável"""
         try:
             logger.info("Fazendo requisição externa", url=target_url, method=method)
             
+            stale = plan.get("stale") if plan is not None else None
+            if plan is not None:
+                # A resposta alimenta o cache: o condicional do cliente é avaliado no gateway e
+                # o upstream só recebe os validadores da entrada expirada, se houver
+                headers = {
+                    name: value for name, value in (headers or {}).items()
+                    if name not in CONDITIONAL_REQUEST_HEADERS
+                }
+                if stale is not None:
+                    validators = revalidation_headers(stale)
+                    if validators:
+                        headers.update(validators)
+                        cache_metrics["upstream_revalidations"] += 1
+                    else:
+                        stale = None
+            
+            started = time.monotonic()
             response = await self.http_client.request(
                 method=method,
                 url=target_url,
@@ -150,25 +2893,61 @@ class ProxyService:
                 json=json_data,
                 headers=headers
             )
+            fetch_time = time.monotonic() - started
             
-            response_data = {
-                "status_code": response.status_code,
-                "data": response.json() if response.content else None,
-                "headers": dict(response.headers)
+            if stale is not None and response.status_code == 304:
+                return await self._refresh_stale(plan, stale, response)
+            
+            # O corpo segue bruto até o cliente, sem decodificar / recodificar JSON
+            response_headers = {
+                name: response.headers[name] for name in CACHED_RESPONSE_HEADERS if name in response.headers
             }
             
+            generated_etag = False
+            if plan is not None and response.status_code == 200:
+                etag = response_headers.get("etag")
+                if not etag or etag.startswith("W/"):
+                    response_headers["etag"] = strong_etag(response.content)
+                    generated_etag = True
+            
             # Armazenar em cache se for GET e resposta for bem-sucedida
-            if method.upper() == "GET" and 200 <= response.status_code < 300:
-                cache_key = self.cache._generate_cache_key(method, target_url, params)
-                cache_data = {
-                    "data": response_data,
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-                await self.cache.set(cache_key, cache_data)
+            if plan is not None and 200 <= response.status_code < 300 and self._cacheable_variant(plan, response):
+                freshness = (plan["ttl"], plan["stale_ttl"], 0)
+                if plan["honor_cache_control"]:
+                    freshness = upstream_freshness(response.headers, plan["ttl"], plan["stale_ttl"])
+                if freshness is None:
+                    cache_metrics["uncacheable_responses"] += 1
+                else:
+                    ttl, stale_ttl, age = freshness
+                    if "cache-control" not in response_headers:
+                        response_headers["cache-control"] = downstream_cache_control(
+                            ttl, stale_ttl, private="authorization" in plan["vary"]
+                        )
+                        # Caches downstream precisam separar as variantes que a chave separa
+                        if plan["vary"]:
+                            response_headers["vary"] = merge_vary(response_headers.get("vary"), sorted(plan["vary"]))
+                    entry = {
+                        "status_code": response.status_code,
+                        "headers": response_headers,
+                        "timestamp": time.time() - age,
+                        "generated_etag": generated_etag,
+                        "fetch_time": fetch_time,
+                        "body": response.content
+                    }
+                    await self.cache.set(
+                        plan["key"], entry, ttl=ttl, stale_ttl=stale_ttl,
+                        tags=plan["tags"], compress=plan["compress"]
+                    )
+                    response_headers = {**response_headers, "age": str(age)}
+            elif plan is not None:
+                await self._store_negative(plan, response, response_headers)
             
             return {
-                "data": response_data,
-                "cached": False
+                "status_code": response.status_code,
+                "headers": response_headers,
+                "body": response.content,
+                "cached": False,
+                "cache_status": "MISS"
             }
             
         except httpx.RequestError as e:
@@ -181,7 +2960,7 @@ class ProxyService:
 # Dependências
 async def get_cache_service() -> CacheService:
     """Dependency para obter serviço de cache"""
-    return CacheService(redis_client)
+    return CacheService(redis_ring or redis_client, local_cache)
 
 async def get_proxy_service(cache_service: CacheService = Depends(get_cache_service)) -> ProxyService:
     """Dependency para obter serviço de proxy"""
@@ -190,21 +2969,85 @@ async def get_proxy_service(cache_service: CacheService = Depends(get_cache_serv
 @app.on_event("startup")
 async def startup_event():
     """Inicialização da aplicação"""
-    global redis_client
+    global redis_client, redis_ring, redis_monitor, policy_watcher, hot_key_refresher
+    global tracking_invalidator, tracking_listener, invalidation_subscriber
+    
+    policy_watcher = asyncio.create_task(watch_cache_policy())
+    if hot_keys is not None and local_cache is not None:
+        hot_key_refresher = asyncio.create_task(refresh_hot_keys())
     
     try:
         # Conectar ao Redis
-        redis_client = redis.Redis(
-            host=REDIS_HOST,
-            port=REDIS_PORT,
-            decode_responses=True,
-            socket_connect_timeout=5,
-            socket_timeout=5
+        names = [f"{host}:{port}" for host, port in REDIS_NODE_ADDRESSES]
+        replica_names = [f"{host}:{port}" for host, port in REDIS_REPLICA_ADDRESSES]
+        read_replicas = REDIS_READ_FROM_REPLICAS and not REDIS_CLUSTER and bool(REDIS_REPLICA_ADDRESSES)
+        if read_replicas and len(REDIS_NODE_ADDRESSES) > 1:
+            logger.warning("REDIS_REPLICAS ignorado com múltiplos nós primários", nodes=names)
+            read_replicas = False
+        socket_path = REDIS_SOCKET_PATH or None
+        if socket_path and (len(REDIS_NODE_ADDRESSES) > 1 or REDIS_CLUSTER):
+            logger.warning("REDIS_SOCKET_PATH ignorado com múltiplos nós Redis", nodes=names)
+            socket_path = None
+        if socket_path:
+            names = [f"unix:{socket_path}"]
+        tracking = L1_CACHE_INVALIDATION == "tracking" and local_cache is not None
+        if tracking and (len(REDIS_NODE_ADDRESSES) > 1 or REDIS_CLUSTER or read_replicas):
+            # Cada nó exigiria sua própria conexão de invalidação: o L1 fica com o barramento e o TTL
+            logger.warning("CLIENT TRACKING desativado com múltiplos nós Redis", nodes=names + replica_names)
+            tracking = False
+        if REDIS_CLUSTER:
+            # Nós iniciais: a topologia (slots, primários e réplicas) é descoberta pelo cliente
+            nodes = [
+                redis.RedisCluster(
+                    startup_nodes=[ClusterNode(host, port) for host, port in REDIS_NODE_ADDRESSES],
+                    read_from_replicas=REDIS_READ_FROM_REPLICAS,
+                    **redis_connection_options()
+                )
+            ]
+            names = [f"cluster({','.join(names)})"]
+        elif tracking:
+            # Conexão de invalidação primeiro: seu id é o REDIRECT das conexões rastreadas
+            host, port = REDIS_NODE_ADDRESSES[0]
+            tracking_invalidator = TrackingInvalidator(local_cache, host, port, socket_path)
+            client_id = await tracking_invalidator.connect()
+            pool = None
+            if L1_TRACKING_MODE == "bcast":
+                # O prefixo é rastreado pela conexão do próprio invalidador: pool de dados comum
+                nodes = [create_redis_client(host, port, socket_path)]
+            else:
+                address = {"path": socket_path} if socket_path else {"host": host, "port": port}
+                pool = redis.ConnectionPool(
+                    connection_class=TrackingUnixConnection if socket_path else TrackingConnection,
+                    tracking_redirect=client_id,
+                    **address,
+                    **redis_connection_options()
+                )
+                nodes = [redis.Redis(connection_pool=pool)]
+            tracking_listener = asyncio.create_task(tracking_invalidator.run(pool))
+            logger.info("Invalidação do L1 via CLIENT TRACKING", mode=L1_TRACKING_MODE, client_id=client_id)
+        else:
+            nodes = [create_redis_client(host, port, socket_path) for host, port in REDIS_NODE_ADDRESSES]
+        replicas = [create_redis_client(host, port) for host, port in REDIS_REPLICA_ADDRESSES] if read_replicas else []
+        redis_ring = RedisRing(nodes, names, replicas=replicas, replica_names=replica_names)
+        redis_client = nodes[0]
+        
+        # Testar conexão: com vários nós, basta um disponível (os demais entram pelo monitor)
+        results = await asyncio.gather(*(node.ping() for node in nodes + replicas), return_exceptions=True)
+        failures = [result for result in results[:len(nodes)] if isinstance(result, Exception)]
+        if len(failures) == len(nodes):
+            raise failures[0]
+        for node, result in zip(nodes + replicas, results):
+            if isinstance(result, Exception):
+                redis_ring.report_failure(node, result)
+        logger.info(
+            "Conectado ao Redis", nodes=names, unavailable=len(failures),
+            replicas=replica_names if replicas else [], read_from_replicas=REDIS_READ_FROM_REPLICAS
         )
         
-        # Testar conexão
-        await redis_client.ping()
-        logger.info("Conectado ao Redis", host=REDIS_HOST, port=REDIS_PORT)
+        if len(nodes) > 1 or replicas:
+            redis_monitor = asyncio.create_task(redis_ring.monitor())
+        if invalidation_bus is not None:
+            invalidation_subscriber = asyncio.create_task(invalidation_bus.run(redis_ring))
         
     except Exception as e:
         logger.error("Erro ao conectar ao Redis", error=str(e))
@@ -213,8 +3056,20 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """Limpeza na finalização da aplicação"""
-    if redis_client:
-        await redis_client.close()
+    if policy_watcher:
+        policy_watcher.cancel()
+    if hot_key_refresher:
+        hot_key_refresher.cancel()
+    if invalidation_subscriber:
+        invalidation_subscriber.cancel()
+    if redis_monitor:
+        redis_monitor.cancel()
+    if tracking_listener:
+        tracking_listener.cancel()
+        await tracking_invalidator.close()
+    if redis_ring:
+        # Pools criados à parte (modo tracking) não são fechados pelo close()
+        await redis_ring.close()
     await http_client.aclose()
 
 # Rotas
@@ -237,26 +3092,174 @@ async def health_check():
         "timestamp": datetime.utcnow().isoformat()
     }
     
-    try:
-        await redis_client.ping()
+    nodes = redis_ring.nodes if redis_ring is not None else [redis_client]
+    results = await asyncio.gather(*(node.ping() for node in nodes if node is not None), return_exceptions=True)
+    available = sum(result is True for result in results)
+    if available == len(nodes):
         health_status["redis"] = "healthy"
-    except Exception:
+    elif available:
+        # Chaves dos nós fora do ar são atendidas pelos próximos nós do anel
+        health_status["redis"] = "degraded"
+    else:
         health_status["redis"] = "unhealthy"
     
     return health_status
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Estatísticas do cache (L1 e Redis)"""
+    redis_lookups = cache_metrics["redis_hits"] + cache_metrics["redis_misses"]
+    stored_entries = cache_metrics["stored_entries"]
+    return {
+        "l1": local_cache.stats() if local_cache is not None else {"enabled": False},
+        "l1_tracking": tracking_invalidator.stats() if tracking_invalidator is not None else {"enabled": False},
+        "invalidation_bus": invalidation_bus.stats() if invalidation_bus is not None else {"enabled": False},
+        "redis_nodes": redis_ring.stats() if redis_ring is not None else {"enabled": False},
+        "redis_batching": redis_batcher.stats() if redis_batcher is not None else {"enabled": False},
+        "redis_latency": redis_latency.stats() if redis_latency is not None else {"enabled": False},
+        "redis": {
+            "hits": cache_metrics["redis_hits"],
+            "misses": cache_metrics["redis_misses"],
+            "hit_ratio": round(cache_metrics["redis_hits"] / redis_lookups, 4) if redis_lookups else 0.0
+        },
+        "compression": {
+            "codec": cache_codec,
+            "min_size": CACHE_COMPRESSION_MIN_SIZE,
+            "stored_entries": stored_entries,
+            "compressed_entries": cache_metrics["compressed_entries"],
+            "avg_body_bytes": round(cache_metrics["stored_body_bytes"] / stored_entries, 1) if stored_entries else 0.0,
+            "avg_stored_bytes": round(cache_metrics["stored_bytes"] / stored_entries, 1) if stored_entries else 0.0,
+            "ratio": round(cache_metrics["stored_bytes"] / cache_metrics["stored_body_bytes"], 4)
+            if cache_metrics["stored_body_bytes"] else 0.0,
+            "compressed_passthrough": cache_metrics["compressed_passthrough"]
+        },
+        "early_refresh": {
+            "enabled": CACHE_EARLY_REFRESH,
+            "beta": CACHE_EARLY_REFRESH_BETA,
+            "ttl_jitter": CACHE_TTL_JITTER,
+            "triggered": cache_metrics["early_refreshes"]
+        },
+        "negative": {
+            "ttl": NEGATIVE_CACHE_TTL,
+            "error_ttl_ms": ERROR_CACHE_TTL_MS,
+            "stored": cache_metrics["negative_stores"],
+            "errors_stored": cache_metrics["error_stores"],
+            "hits": cache_metrics["negative_hits"]
+        },
+        "conditional": {
+            "not_modified_responses": cache_metrics["not_modified_responses"],
+            "bytes_saved": cache_metrics["not_modified_bytes_saved"],
+            "upstream_revalidations": cache_metrics["upstream_revalidations"],
+            "upstream_not_modified": cache_metrics["upstream_not_modified"]
+        },
+        "single_flight": {
+            "mode": SINGLE_FLIGHT_MODE,
+            "in_flight": len(single_flight),
+            "coalesced_requests": cache_metrics["coalesced_requests"]
+        },
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+@app.get("/cache/hot-keys")
+async def get_hot_keys():
+    """Chaves mais lidas do cache neste processo (top-K estimado) e quais estão fixadas no L1"""
+    if hot_keys is None:
+        return {"enabled": False}
+    pinned = local_cache.pinned if local_cache is not None else set()
+    return {
+        "enabled": True,
+        "top_k": hot_keys.top_k,
+        "min_hits": hot_keys.min_hits,
+        "decay_interval": hot_keys.decay_interval,
+        "refresh_interval": HOT_KEYS_REFRESH_INTERVAL,
+        "sketch": {"width": hot_keys.width, "depth": hot_keys.depth},
+        "keys": [
+            {"key": key, "count": count, "hot": count >= hot_keys.min_hits, "pinned": key in pinned}
+            for key, count in hot_keys.hot_keys()
+        ],
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
 @app.delete("/cache")
 async def clear_cache(
     pattern: str = "gateway_cache:*",
+    service: Optional[str] = None,
+    prefix: Optional[str] = None,
+    tag: Optional[str] = None,
+    wait: bool = False,
     cache_service: CacheService = Depends(get_cache_service)
 ):
-    """Limpar cache por padrão"""
-    deleted_count = await cache_service.delete(pattern)
+    """Limpar cache por tag, por serviço / prefixo de rota (O(1)) ou por padrão (job em background)"""
+    if tag is not None:
+        deleted_count = await cache_service.invalidate_tags([tag])
+        return {
+            "message": f"Cache limpo: {deleted_count} chaves removidas",
+            "tag": tag
+        }
+    if service is not None:
+        generation = await cache_service.bump_namespace(service, prefix)
+        return {
+            "message": "Namespace invalidado",
+            "service": service,
+            "prefix": route_prefix(prefix) if prefix is not None else None,
+            "generation": generation
+        }
+    if prefix is not None:
+        raise HTTPException(status_code=400, detail="O parâmetro 'prefix' requer 'service'")
+    
+    job = start_invalidation_job(pattern, cache_service)
+    if wait:
+        await job.wait()
+        return {
+            "message": f"Cache limpo: {job.deleted} chaves removidas",
+            "pattern": pattern,
+            "job": job.to_dict()
+        }
     return {
-        "message": f"Cache limpo: {deleted_count} chaves removidas",
-        "pattern": pattern
+        "message": "Limpeza de cache iniciada",
+        "pattern": pattern,
+        "job": job.to_dict()
     }
 
+@app.get("/cache/jobs")
+async def list_invalidation_jobs():
+    """Listar jobs de invalidação recentes"""
+    return {"jobs": [job.to_dict() for job in reversed(invalidation_jobs.values())]}
+
+@app.get("/cache/jobs/{job_id}")
+async def get_invalidation_job(job_id: str):
+    """Progresso de um job de invalidação"""
+    job = invalidation_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' não encontrado")
+    return job.to_dict()
+
+@app.delete("/cache/jobs/{job_id}")
+async def cancel_invalidation_job(job_id: str):
+    """Cancelar um job de invalidação em execução"""
+    job = invalidation_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' não encontrado")
+    cancelled = job.cancel()
+    return {
+        "message": "Job cancelado" if cancelled else "Job não está em execução",
+        "job": job.to_dict()
+    }
+
+@app.get("/cache/policy")
+async def get_cache_policy():
+    """Política de cache em uso"""
+    return cache_policy.to_dict()
+
+@app.post("/cache/policy/reload")
+async def reload_policy():
+    """Recarregar a política de cache do arquivo"""
+    try:
+        reload_cache_policy(force=True)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Política de cache inválida: {e}")
+    return {"message": "Política de cache recarregada", "policy": cache_policy.to_dict()}
+
 # Rotas de proxy para serviços
 
 @app.api_route("/api/{service}/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
@@ -270,7 +3273,8 @@ async def proxy_request(
     
     # Extrair dados da requisição
     method = request.method
-    params = dict(request.query_params)
+    # Lista de pares: parâmetros repetidos (?tag=a&tag=b) são preservados
+    params = request.query_params.multi_items()
     headers = dict(request.headers)
     
     # Remover headers que podem causar problemas
@@ -295,13 +3299,16 @@ async def proxy_request(
         headers=headers
     )
     
-    # Retornar resposta
-    response_data = result["data"]
-    return JSONResponse(
-        content=response_data["data"],
-        status_code=response_data["status_code"],
+    if method == "GET" and result["status_code"] == 200 and is_not_modified(headers, result["headers"]):
+        result = not_modified(result)
+    
+    # Retornar resposta com o corpo bruto do upstream / cache
+    return Response(
+        content=result["body"],
+        status_code=result["status_code"],
         headers={
-            "X-Cache-Status": "HIT" if result["cached"] else "MISS",
+            **result["headers"],
+            "X-Cache-Status": result["cache_status"],
             "X-Gateway-Version": "1.0.0"
         }
     )
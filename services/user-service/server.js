@@ -8,6 +8,9 @@ require('dotenv').config();
 const app = express();
 const PORT = process.env.PORT || 3001;
 
+// Strong ETags (body hash) so the gateway can revalidate expired entries with If-None-Match
+app.set('etag', 'strong');
+
 // Middleware
 app.use(helmet());
 app.use(cors());